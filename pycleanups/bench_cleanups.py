@@ -0,0 +1,723 @@
+"""
+bench_cleanups.py
+Performance benchmarks for cleanups.py
+
+Run ``python -m bench_cleanups --help`` for usage.  Each benchmark measures
+the current implementation, and where there is one, a baseline implementation
+for comparison, at each of the sizes given on the command line (by default
+from 100 to 1,000,000).  The results can be written as JSON with ``--json`` and
+compared against the JSON of an earlier run with ``--baseline``, in which case
+the exit status is ``1`` if any result regressed by more than ``--tolerance``.
+
+Copyright (C) 2010  Denver Coneybeare
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import gc
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import cleanups
+from cleanups import CleanupListener
+from cleanups import Cleanups
+from cleanups import DebugCleanupListener
+from cleanups import LoggingCleanupListener
+from cleanups import TimingCleanupListener
+
+################################################################################
+
+class ListCleanups(Cleanups):
+    """
+    A `Cleanups` that stores its cleanups in a list, the way that `Cleanups`
+    itself did before it indexed them by ID.  It is used as the
+    baseline that the current implementation is compared against.
+    """
+
+    def __init__(self):
+        Cleanups.__init__(self, atexit_register=False)
+        self.cleanups = []
+
+    def add(self, func, *args, **kwargs):
+        with self.lock:
+            cleanup = self._new_cleanup(func, args, kwargs)
+            self.cleanups.append(cleanup)
+        return cleanup
+
+    def add_to_front(self, func, *args, **kwargs):
+        with self.lock:
+            cleanup = self._new_cleanup(func, args, kwargs)
+            self.cleanups.insert(0, cleanup)
+        return cleanup
+
+    def remove(self, cleanup):
+        with self.lock:
+            self.cleanups.remove(cleanup)
+
+    def __contains__(self, cleanup):
+        with self.lock:
+            return cleanup in self.cleanups
+
+################################################################################
+
+class DictCleanup():
+    """
+    A replacement for `cleanups.Cleanup` that stores its attributes in an
+    instance dict and always copies its arguments, the way that
+    ``cleanups.Cleanup`` did before it used ``__slots__``, but with all of the
+    attributes that ``cleanups.Cleanup`` has now, so that the two are compared
+    like for like.
+    """
+
+    def __init__(self, cleanups, id, func, args, kwargs):
+        self.cleanups = cleanups
+        self.id = id
+        self.func = func
+        self.args = tuple(args)
+        self.kwargs = dict(kwargs)
+        self.name = None
+        self.priority = 0
+        self.run_in_process = False
+        self.timeout = None
+        self.best_effort = False
+        self.inheritable = False
+        self.tags = ()
+        self.key = None
+
+class DictCleanups(Cleanups):
+    """
+    A `Cleanups` that creates `DictCleanup` objects instead of
+    ``cleanups.Cleanup`` objects.
+    """
+
+    def __init__(self):
+        Cleanups.__init__(self, atexit_register=False)
+
+    def _new_cleanup(self, func, args, kwargs):
+        return DictCleanup(self, next(self.cleanup_ids), func, args, kwargs)
+
+################################################################################
+
+def noop():
+    pass
+
+def bench_add(cls, n):
+    x = cls()
+    start = time.perf_counter()
+    for i in range(n):
+        x.add(noop)
+    return time.perf_counter() - start
+
+def bench_add_to_front(cls, n):
+    x = cls()
+    start = time.perf_counter()
+    for i in range(n):
+        x.add_to_front(noop)
+    return time.perf_counter() - start
+
+def bench_remove(cls, n):
+    x = cls()
+    handles = [x.add(noop) for i in range(n)]
+    start = time.perf_counter()
+    for handle in handles:
+        x.remove(handle)
+    return time.perf_counter() - start
+
+def bench_contains(cls, n):
+    x = cls()
+    handles = [x.add(noop) for i in range(n)]
+    start = time.perf_counter()
+    for handle in handles:
+        handle in x
+    return time.perf_counter() - start
+
+BENCHMARKS = (
+    ("add", bench_add),
+    ("add_to_front", bench_add_to_front),
+    ("remove", bench_remove),
+    ("__contains__", bench_contains),
+)
+
+def memory_per_cleanup(cls, n, *args):
+    """
+    Returns the number of bytes allocated per cleanup when registering ``n``
+    cleanups with the given positional arguments with a new ``cls``.
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        x = cls()
+        start = tracemalloc.get_traced_memory()[0]
+        for i in range(n):
+            x.add(noop, *args)
+        end = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return (end - start) / n
+
+class NoopCleanupListener(CleanupListener):
+    """
+    A `CleanupListener` that overrides every method to do nothing.
+    """
+
+    def starting(self, cleanups, cleanup):
+        pass
+
+    def completed(self, cleanups, cleanup, retval):
+        pass
+
+    def failed(self, cleanups, cleanup, exc_info):
+        pass
+
+def bench_run(n, num_listeners, listener_class=NoopCleanupListener):
+    """
+    Returns the number of seconds taken to run ``n`` cleanups with the given
+    number of listeners of the given class registered.
+    """
+    x = Cleanups(atexit_register=False)
+    for i in range(num_listeners):
+        x.add_listener(listener_class())
+    for i in range(n):
+        x.add(noop)
+    start = time.perf_counter()
+    x.run()
+    return time.perf_counter() - start
+
+LISTENER_COUNTS = (0, 1, 10)
+
+class SlowFile():
+    """
+    A file that takes 50 microseconds to write each string, without holding
+    the GIL, like a terminal or a pipe to a slow reader would.
+    """
+
+    def write(self, s):
+        time.sleep(0.00005)
+
+    def flush(self):
+        pass
+
+def sleep_50us():
+    time.sleep(0.00005)
+
+def bench_run_logging(n, listener_class):
+    """
+    Returns the number of seconds taken to run ``n`` cleanups that each wait
+    50 microseconds for I/O with a listener of the given class that logs every
+    event to a `SlowFile`, including the time taken to flush the log when the
+    run finishes.
+    """
+    f = SlowFile()
+    if listener_class is DebugCleanupListener:
+        listener = DebugCleanupListener(f)
+    else:
+        logger = logging.getLogger("bench_cleanups")
+        logger.propagate = False
+        logger.setLevel(logging.DEBUG)
+        logger.handlers[:] = [logging.StreamHandler(f)]
+        listener = listener_class(logger)
+    x = Cleanups(atexit_register=False)
+    x.add_listener(listener)
+    for i in range(n):
+        x.add(sleep_50us)
+    start = time.perf_counter()
+    x.run()
+    return time.perf_counter() - start
+
+def bench_add_many(n, method):
+    """
+    Returns the number of seconds taken to register ``n`` cleanups with
+    `Cleanups.add()` if ``method`` is ``"add"`` or with a single call to
+    `Cleanups.add_many()` if it is ``"add_many"``.
+    """
+    x = Cleanups(atexit_register=False)
+    items = [(noop, (i,), {}) for i in range(n)]
+    start = time.perf_counter()
+    if method == "add":
+        for (func, args, kwargs) in items:
+            x.add(func, *args, **kwargs)
+    else:
+        x.add_many(items)
+    return time.perf_counter() - start
+
+TAGGED = 100
+
+def bench_tagged(n, method):
+    """
+    Returns the number of seconds taken to run or remove `TAGGED` cleanups
+    with one tag out of ``n`` registered cleanups, using ``run(tag=tag)`` if
+    ``method`` is ``"run"`` or `Cleanups.remove_tagged()` if it is
+    ``"remove_tagged"``.  This should not depend on ``n``.
+    """
+    x = Cleanups(atexit_register=False)
+    x.add_many([(noop, (), {})] * max(0, n - TAGGED))
+    for i in range(min(n, TAGGED)):
+        x.add_tagged("job", noop)
+    start = time.perf_counter()
+    if method == "run":
+        x.run(tag="job")
+    else:
+        x.remove_tagged("job")
+    elapsed = time.perf_counter() - start
+    x.clear()
+    return elapsed
+
+def bench_since(n, method):
+    """
+    Returns the number of seconds taken to unregister the last `TAGGED` of
+    ``n`` registered cleanups, using `Cleanups.remove()` for each of them if
+    ``method`` is ``"remove"`` or a savepoint and `Cleanups.discard_since()`
+    or `Cleanups.run_since()` if it is ``"discard_since"`` or
+    ``"run_since"``.  This should not depend on ``n``.
+    """
+    x = Cleanups(atexit_register=False)
+    x.add_many([(noop, (), {})] * max(0, n - TAGGED))
+    mark = x.savepoint()
+    handles = x.add_many([(noop, (), {})] * min(n, TAGGED))
+    start = time.perf_counter()
+    if method == "remove":
+        for handle in reversed(handles):
+            x.remove(handle)
+    elif method == "discard_since":
+        x.discard_since(mark)
+    else:
+        x.run_since(mark)
+    elapsed = time.perf_counter() - start
+    x.clear()
+    return elapsed
+
+def bench_add_unlink_repeated(n, keyed):
+    """
+    Returns the number of seconds taken to register `TAGGED` files for
+    deletion ``n`` times in total with `Cleanups.add_unlink()`, with or without
+    the path as the key, and then run the cleanups.
+    """
+    with tempfile.TemporaryDirectory() as dir:
+        (dirs, files) = make_tree(dir, TAGGED)
+        x = Cleanups(atexit_register=False)
+        start = time.perf_counter()
+        for i in range(n):
+            path = files[i % len(files)]
+            x.add_unlink(path, key=path if keyed else None)
+        x.run()
+        return time.perf_counter() - start
+
+def bench_add_unlink(n, journal, many=False):
+    """
+    Returns the number of seconds taken to register ``n`` files for deletion
+    with `Cleanups.add_unlink()`, or with a single call to
+    `Cleanups.add_unlink_many()` if ``many`` is ``True``, with or without a
+    journal.
+    """
+    with tempfile.TemporaryDirectory() as dir:
+        if journal:
+            x = Cleanups(atexit_register=False,
+                journal=os.path.join(dir, "journal"))
+        else:
+            x = Cleanups(atexit_register=False)
+        paths = [os.path.join(dir, "file%i" % i) for i in range(n)]
+        start = time.perf_counter()
+        if many:
+            x.add_unlink_many(paths)
+        else:
+            for path in paths:
+                x.add_unlink(path)
+        elapsed = time.perf_counter() - start
+        if journal:
+            x.journal.close()
+    return elapsed
+
+def bench_contention(cls, num_threads, n):
+    """
+    Returns the number of seconds taken for ``num_threads`` threads to add and
+    then remove ``n`` cleanups in total, split evenly between them, to/from a
+    single shared ``cls``.
+    """
+    x = cls()
+    barrier = threading.Barrier(num_threads + 1)
+    def worker():
+        barrier.wait()
+        for i in range(n // num_threads):
+            x.remove(x.add(noop))
+    threads = [threading.Thread(target=worker) for i in range(num_threads)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start
+
+THREAD_COUNTS = (1, 8, 64)
+
+def bench_dispatch(n, num_listeners):
+    """
+    Returns the number of seconds taken for a ``_CleanupListenerNotifier`` to
+    dispatch ``n`` `CleanupListener.completed()` events to the given number of
+    listeners.
+    """
+    x = Cleanups(atexit_register=False)
+    listeners = tuple(NoopCleanupListener() for i in range(num_listeners))
+    notifier = cleanups._CleanupListenerNotifier(x, (), listeners)
+    cleanup = x.add(noop)
+    start = time.perf_counter()
+    for i in range(n):
+        notifier.completed(cleanup, None)
+    elapsed = time.perf_counter() - start
+    x.clear()
+    return elapsed
+
+FILES_PER_DIR = 1000
+
+def make_tree(dir, n):
+    """
+    Creates ``n`` empty files in subdirectories of ``dir`` with `FILES_PER_DIR`
+    files each, returning the list of the subdirectories and the list of the
+    files.
+    """
+    dirs = []
+    files = []
+    for i in range(n):
+        if i % FILES_PER_DIR == 0:
+            dirs.append(os.path.join(dir, "d%i" % len(dirs)))
+            os.mkdir(dirs[-1])
+        files.append(os.path.join(dirs[-1], "f%i" % i))
+        os.close(os.open(files[-1], os.O_WRONLY | os.O_CREAT))
+    return (dirs, files)
+
+def bench_unlink_tree(n, method, max_workers=None):
+    """
+    Returns the number of seconds taken by `Cleanups.run()` to delete ``n``
+    files created by `make_tree()`, each registered with
+    ``Cleanups.add(os.unlink, path)`` if ``method`` is ``"add"`` or with
+    `Cleanups.add_unlink()` if it is ``"add_unlink"``.
+    """
+    with tempfile.TemporaryDirectory() as dir:
+        (dirs, files) = make_tree(dir, n)
+        x = Cleanups(atexit_register=False, max_workers=max_workers)
+        for path in files:
+            if method == "add":
+                x.add(os.unlink, path)
+            else:
+                x.add_unlink(path)
+        start = time.perf_counter()
+        x.run()
+        return time.perf_counter() - start
+
+def bench_rmtree_tree(n, method):
+    """
+    Returns the number of seconds taken by `Cleanups.run()` to delete the
+    directories created by `make_tree()` for ``n`` files, each registered with
+    ``Cleanups.add(shutil.rmtree, path)`` if ``method`` is ``"add"`` or with
+    `Cleanups.add_rmtree()` if it is ``"add_rmtree"``.
+    """
+    with tempfile.TemporaryDirectory() as dir:
+        (dirs, files) = make_tree(dir, n)
+        x = Cleanups(atexit_register=False)
+        for path in dirs:
+            if method == "add":
+                x.add(shutil.rmtree, path)
+            else:
+                x.add_rmtree(path)
+        start = time.perf_counter()
+        x.run()
+        return time.perf_counter() - start
+
+MEMORY_BENCHMARKS = (
+    ("no arguments", ()),
+    ("one argument", ("/tmp/file",)),
+)
+
+EAGER_IMPORTS = ("asyncio", "concurrent.futures", "functools", "heapq",
+    "inspect", "mmap", "operator", "queue", "shutil", "signal", "struct",
+    "threading", "traceback", "weakref")
+"""The modules that cleanups.py imported at the top level before it deferred
+importing them until they are used"""
+
+def import_times(code):
+    """
+    Runs ``code`` in a new interpreter with ``python -X importtime``, returning
+    a dict that maps the name of each module imported by ``code`` itself, as
+    opposed to by other modules, to the number of microseconds taken to import
+    it, including the modules that it imported.  Bytecode is written and
+    reused, as in a normal installation, even if ``PYTHONDONTWRITEBYTECODE``
+    is set, so that the times do not include compiling cleanups.py.
+    """
+    env = dict(os.environ)
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+        cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+        stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    times = {}
+    for line in process.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        fields = line.split("|")
+        if len(fields) == 3 and not fields[2].startswith("  "):
+            try:
+                times[fields[2].strip()] = int(fields[1])
+            except ValueError:
+                pass # the header line
+    return times
+
+def bench_import(repeat=20):
+    """
+    Returns a tuple ``(eager, current)`` of the median number of microseconds
+    taken, as reported by ``python -X importtime``, to import the modules in
+    `EAGER_IMPORTS` and to import cleanups.py, each in a new interpreter.
+    """
+    eager = []
+    current = []
+    import_times("import cleanups") # compiles cleanups.py, if necessary
+    for i in range(repeat):
+        times = import_times("import " + ", ".join(EAGER_IMPORTS))
+        eager.append(sum(times.get(name, 0) for name in EAGER_IMPORTS))
+        current.append(import_times("import cleanups")["cleanups"])
+    return (statistics.median(eager), statistics.median(current))
+
+################################################################################
+
+def new_cleanups():
+    return Cleanups(atexit_register=False)
+
+QUADRATIC_MAX_N = 10000
+"""The largest size at which to measure baselines whose running time grows
+quadratically"""
+
+SLEEP_MAX_N = 10000
+"""The largest size at which to measure benchmarks that sleep for each
+cleanup"""
+
+def _suite():
+    """
+    Returns the benchmarks as a list of tuples ``(name, unit, variants)``,
+    where ``variants`` is a list of tuples ``(variant, func, max_n)``: ``func``
+    is invoked with the size ``n`` and returns the measurement, in ``unit``,
+    and ``max_n`` is the largest size at which to measure it, or ``None`` for
+    no limit.  Measurements that do not depend on the size are invoked with
+    ``n`` equal to ``None``, and their ``max_n`` is ``0``.
+    """
+    suite = []
+    for (name, bench) in BENCHMARKS:
+        suite.append((name, "s", [
+            ("list", lambda n, bench=bench: bench(ListCleanups, n),
+                None if bench is bench_add else QUADRATIC_MAX_N),
+            ("current", lambda n, bench=bench: bench(new_cleanups, n), None),
+        ]))
+    suite.append(("run()", "s", [
+        ("%i listeners" % count, lambda n, count=count: bench_run(n, count),
+            None)
+        for count in LISTENER_COUNTS] + [
+        ("timing", lambda n: bench_run(n, 1, TimingCleanupListener), None),
+    ]))
+    suite.append(("dispatch", "s", [
+        ("%i listeners" % count,
+            lambda n, count=count: bench_dispatch(n, count), None)
+        for count in LISTENER_COUNTS]))
+    suite.append(("slow log", "s", [
+        ("debug", lambda n: bench_run_logging(n, DebugCleanupListener),
+            SLEEP_MAX_N),
+        ("logging", lambda n: bench_run_logging(n, LoggingCleanupListener),
+            SLEEP_MAX_N),
+    ]))
+    suite.append(("add_many()", "s", [
+        ("add", lambda n: bench_add_many(n, "add"), None),
+        ("add_many", lambda n: bench_add_many(n, "add_many"), None),
+    ]))
+    suite.append(("%i tagged" % TAGGED, "s", [
+        ("run(tag)", lambda n: bench_tagged(n, "run"), None),
+        ("remove_tagged", lambda n: bench_tagged(n, "remove_tagged"), None),
+    ]))
+    suite.append(("last %i since savepoint" % TAGGED, "s", [
+        ("remove", lambda n: bench_since(n, "remove"), None),
+        ("discard_since", lambda n: bench_since(n, "discard_since"), None),
+        ("run_since", lambda n: bench_since(n, "run_since"), None),
+    ]))
+    suite.append(("%i files repeated" % TAGGED, "s", [
+        ("add_unlink", lambda n: bench_add_unlink_repeated(n, False), None),
+        ("keyed", lambda n: bench_add_unlink_repeated(n, True), None),
+    ]))
+    suite.append(("add_unlink()", "s", [
+        ("no journal", lambda n: bench_add_unlink(n, False), None),
+        ("journal", lambda n: bench_add_unlink(n, True), None),
+        ("many", lambda n: bench_add_unlink(n, False, True), None),
+        ("many, journal", lambda n: bench_add_unlink(n, True, True), None),
+    ]))
+    suite.append(("unlink tree", "s", [
+        ("add", lambda n: bench_unlink_tree(n, "add"), None),
+        ("add_unlink", lambda n: bench_unlink_tree(n, "add_unlink"), None),
+        ("add_unlink x8", lambda n: bench_unlink_tree(n, "add_unlink", 8),
+            None),
+    ]))
+    suite.append(("rmtree tree", "s", [
+        ("add", lambda n: bench_rmtree_tree(n, "add"), None),
+        ("add_rmtree", lambda n: bench_rmtree_tree(n, "add_rmtree"), None),
+    ]))
+    for count in THREAD_COUNTS:
+        suite.append(("add+remove %i threads" % count, "s", [
+            ("current", lambda n, count=count:
+                bench_contention(new_cleanups, count, n), None),
+        ]))
+    for (name, args) in MEMORY_BENCHMARKS:
+        suite.append(("bytes/cleanup, " + name, "B", [
+            ("dict", lambda n, args=args:
+                memory_per_cleanup(DictCleanups, n, *args), None),
+            ("current", lambda n, args=args:
+                memory_per_cleanup(new_cleanups, n, *args), None),
+        ]))
+    import_results = {}
+    def import_time(index):
+        if not import_results:
+            import_results.update(enumerate(bench_import()))
+        return import_results[index]
+    suite.append(("import", "us", [
+        ("eager", lambda n: import_time(0), 0),
+        ("current", lambda n: import_time(1), 0),
+    ]))
+    return suite
+
+def run_suite(sizes, repeat=3, names=None, out=sys.stdout):
+    """
+    Runs the benchmarks, printing a table of the results to ``out`` as they
+    are measured, and returns the results as a list of dicts with the keys
+    ``"benchmark"``, ``"variant"``, ``"n"``, ``"value"`` and ``"unit"``.  Each
+    value is the minimum of ``repeat`` measurements, or of one measurement for
+    sizes over 100,000.
+
+    :Parameters:
+        sizes : iterable
+            the sizes at which to measure each benchmark
+        repeat : int
+            the number of times to repeat each measurement
+        names : iterable
+            if not ``None``, only the benchmarks whose names contain one of
+            these strings are run
+        out : file
+            the file to which to print the table, or ``None``
+    """
+    results = []
+    for (name, unit, variants) in _suite():
+        if names is not None and not any(x in name for x in names):
+            continue
+        if out is not None:
+            print(file=out)
+            print("%-32s %8s" % ("%s (%s)" % (name, unit), "n") +
+                "".join(" %14s" % variant for (variant, func, max_n)
+                    in variants), file=out)
+        for n in (sizes if variants[0][2] != 0 else (None,)):
+            row = []
+            for (variant, func, max_n) in variants:
+                if max_n is not None and n is not None and n > max_n:
+                    row.append(None)
+                    continue
+                count = 1 if n is None or n > 100000 else repeat
+                value = min(func(n) for i in range(count))
+                row.append(value)
+                results.append({"benchmark": name, "variant": variant, "n": n,
+                    "value": value, "unit": unit})
+            if out is not None:
+                print("%-32s %8s" % ("", "" if n is None else n) +
+                    "".join(" %14s" % ("-" if value is None else "%.6g" % value)
+                        for value in row), file=out)
+                out.flush()
+    return results
+
+def to_json(results):
+    """
+    Returns a dict of the results of `run_suite()` and a description of the
+    environment in which they were measured, to serialize as JSON.
+    """
+    return {
+        "python": platform.python_implementation() + " " +
+            platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+
+def compare(results, baseline, tolerance, out=sys.stdout):
+    """
+    Compares results of `run_suite()` against those of an earlier run, loaded
+    from the JSON written by `to_json()`, printing the ratio of each current
+    value to the baseline value; a ratio greater than ``1 + tolerance`` is
+    reported as a regression.  Returns the number of regressions.
+    """
+    baseline_values = {(x["benchmark"], x["variant"], x["n"]): x["value"]
+        for x in baseline["results"]}
+    print(file=out)
+    print("compared to baseline (%s)" % baseline.get("python"), file=out)
+    regressions = 0
+    for result in results:
+        key = (result["benchmark"], result["variant"], result["n"])
+        baseline_value = baseline_values.get(key)
+        if not baseline_value:
+            continue
+        ratio = result["value"] / baseline_value
+        regressed = ratio > 1 + tolerance
+        regressions += regressed
+        print("%-32s %14s %8s %8.2fx%s" % (result["benchmark"],
+            result["variant"], "" if result["n"] is None else result["n"],
+            ratio, "  REGRESSION" if regressed else ""), file=out)
+    return regressions
+
+def main(args=None):
+    parser = argparse.ArgumentParser(prog="python -m bench_cleanups",
+        description="Runs performance benchmarks for cleanups.py.")
+    parser.add_argument("sizes", nargs="*", type=int,
+        default=[100, 1000, 10000, 100000, 1000000],
+        help="the sizes at which to measure each benchmark (default: 100 to "
+        "1000000 in powers of 10)")
+    parser.add_argument("--filter", action="append", metavar="NAME",
+        help="only run benchmarks whose names contain NAME; may be repeated")
+    parser.add_argument("--repeat", type=int, default=3,
+        help="the number of times to repeat each measurement, keeping the "
+        "fastest (default: %(default)s)")
+    parser.add_argument("--json", metavar="PATH",
+        help="write the results as JSON to PATH, or to standard output if "
+        "PATH is -, in which case the table is not printed")
+    parser.add_argument("--baseline", metavar="PATH",
+        help="compare the results against JSON written by an earlier run")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+        help="the fraction by which a result may exceed the baseline before "
+        "it is reported as a regression (default: %(default)s)")
+    args = parser.parse_args(args)
+
+    out = None if args.json == "-" else sys.stdout
+    results = run_suite(args.sizes, args.repeat, args.filter, out)
+
+    if args.json == "-":
+        json.dump(to_json(results), sys.stdout, indent=1)
+        print()
+    elif args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(to_json(results), f, indent=1)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.tolerance, out or sys.stderr):
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -23,48 +23,381 @@ __all__ = (
     "Cleanups",
     "CleanupListener",
     "DebugCleanupListener",
+    "FileDeletionError",
+    "LoggingCleanupListener",
+    "TimingCleanupListener",
 )
 
+# only modules that are cheap to import are imported here, since this module
+# is imported by short-lived programs that may never register a cleanup; the
+# others, such as asyncio, concurrent.futures, shutil and threading, are
+# imported by the functions that use them
+import _thread
+import _weakref
 import atexit
+import itertools
 import os
-import shutil
-import threading
-import traceback
+import time
 import sys
 
+_NO_KWARGS = {}
+"""The dict shared by all `Cleanup` objects that have no keyword arguments, to
+avoid the cost of an empty dict for each of them; it must never be modified"""
+
 ################################################################################
 
 class Cleanups():
 
     global_listeners = []
-    global_lock = threading.Lock()
-
-    def __init__(self, atexit_register=True):
-        self.cleanups = []
+    global_lock = _thread.allocate_lock()
+
+    def __init__(self, atexit_register=True, max_workers=None, journal=None):
+        # the cleanups added to the back and to the front, keyed by
+        # Cleanup.id; since IDs are assigned while holding self.lock and dicts
+        # preserve insertion order, each of them is sorted by ID, and the order
+        # of registration is reversed(self.front) followed by self.back
+        self.back = {}
+        self.front = {}
+        self.dependencies = {}
+        self.phases = {}
+        self.tags = {}
+        self.keys = {}
         self.listeners = []
-        self.next_cleanup_id = 0
-        self.lock = threading.Lock()
-
-        if atexit_register:
-            atexit.register(self.run)
+        self.cleanup_ids = itertools.count(1)
+        self.lock = _thread.allocate_lock()
+        self.max_workers = max_workers
+        self.atexit_register = atexit_register
+        self.parent = None
+        self.parent_cleanup = None
+        self.journal = None if journal is None else _Journal(journal)
+        # whether a journal, dependencies, tags or keys have ever been used, so
+        # that _discard() only has to check this to know it need not update them
+        self.bookkeeping = journal is not None
+        self.fork_id = 0
+        self.savepoint_id = 0
+        _track_instance(self)
 
     def add(self, func, *args, **kwargs):
         with self.lock:
             cleanup = self._new_cleanup(func, args, kwargs)
-            self.cleanups.append(cleanup)
+            self._insert(cleanup)
         return cleanup
 
     def add_to_front(self, func, *args, **kwargs):
         with self.lock:
             cleanup = self._new_cleanup(func, args, kwargs)
-            self.cleanups.insert(0, cleanup)
+            self._insert(cleanup, last=False)
         return cleanup
 
-    def add_unlink(self, path):
-        self.add(os.unlink, path)
+    def add_many(self, cleanups):
+        """
+        Registers many cleanups, like calling `add()` for each of them but
+        faster, since the cleanups are inserted together while holding the
+        lock only once.  The cleanups are
+        registered in iteration order, and so are executed in reverse of that
+        order like those registered with `add()`.
 
-    def add_rmtree(self, path):
-        self.add(shutil.rmtree, path)
+        :Parameters:
+            cleanups : iterable
+                the cleanups to register, each a tuple ``(func, args, kwargs)``
+                of a function and the positional and keyword arguments with
+                which to invoke it
+
+        Returns a list of the `Cleanup` objects that were registered, in the
+        same order.
+        """
+        # consume the iterable before acquiring the lock, in case iterating it
+        # registers cleanups too
+        items = list(cleanups)
+        if not items:
+            return []
+        cleanup_ids = self.cleanup_ids
+        with self.lock:
+            cleanups = [Cleanup(self, next(cleanup_ids), func, args, kwargs)
+                for (func, args, kwargs) in items]
+            if not (self.back or self.front) and self.atexit_register:
+                _atexit_instances.register(self)
+            self.back.update([(cleanup.id, cleanup) for cleanup in cleanups])
+        return cleanups
+
+    def add_keyed(self, key, func, *args, **kwargs):
+        """
+        Registers a cleanup like `add()` does, unless a cleanup with the given
+        key is already registered, in which case this method does nothing and
+        returns that cleanup instead, such as when code that registers a
+        cleanup for a resource may run repeatedly for the same resource.  Keys
+        are indexed, so this method and `remove_key()` take constant time.
+        The key of a cleanup is stored in `Cleanup.key`.
+
+        :Parameters:
+            key : hashable
+                the key, which must not be ``None``
+            func : callable
+                the function to execute
+
+        :Raises:
+            ValueError : if ``key`` is ``None``
+        """
+        if key is None:
+            raise ValueError("key must not be None")
+        with self.lock:
+            cleanup = self.keys.get(key)
+            if cleanup is None:
+                cleanup = self._new_cleanup(func, args, kwargs)
+                cleanup.key = key
+                self._insert(cleanup)
+                self.keys[key] = cleanup
+                self.bookkeeping = True
+        return cleanup
+
+    def remove_key(self, key):
+        """
+        Unregisters the cleanup with the given key, returning whether there was
+        one.
+        """
+        with self.lock:
+            cleanup = self.keys.get(key)
+            return cleanup is not None and self._discard(cleanup)
+
+    def add_unlink(self, path, key=None):
+        """
+        Registers a cleanup that deletes a file, like ``os.unlink(path)``.
+        Files registered with consecutive calls to this method are deleted by
+        a single cleanup, which deletes them grouped by directory (using paths
+        relative to an open directory where supported); likewise, directory
+        trees registered with consecutive calls to `add_rmtree()` are deleted
+        by a single cleanup, in the reverse order of registration.  Since files
+        and directory trees are never deleted by the same cleanup, deletions
+        are executed in the reverse order of registration relative to each
+        other and to other cleanups.  If
+        `self.max_workers` is not ``None`` at the time that the cleanup is
+        executed then the files are deleted on that many threads.  If any
+        deletions fail then the cleanup raises `FileDeletionError` after
+        attempting all of the others.  If this object was created with a
+        ``journal`` then the absolute path is also recorded in that journal
+        file until the cleanup is executed or removed, so that it can be
+        deleted by `reap()` if this process is killed before then.
+
+        :Parameters:
+            path : string
+                the path of the file to delete; a relative path is interpreted
+                relative to the current directory at the time of deletion
+            key : hashable
+                if not ``None`` then the deletion is registered as a separate
+                cleanup with this key, as if by `add_keyed()`, and nothing is
+                registered if a cleanup with this key is already registered;
+                for example, specifying the path as the key prevents deleting
+                the same file repeatedly when registered repeatedly
+        """
+        self._add_file_deletions(_FileDeletions.add_unlink, _Journal.UNLINK,
+            (path,), key)
+
+    def add_unlink_many(self, paths):
+        """
+        Registers cleanups that delete files, like calling `add_unlink()` for
+        each of them but faster, since the paths are added to the cleanup that
+        deletes them together.
+
+        :Parameters:
+            paths : iterable
+                the paths of the files to delete
+        """
+        self._add_file_deletions(_FileDeletions.add_unlink, _Journal.UNLINK,
+            paths)
+
+    def add_rmtree(self, path, key=None):
+        """
+        Registers a cleanup that deletes a directory tree, like
+        ``shutil.rmtree(path)``.  See `add_unlink()` for details.
+
+        :Parameters:
+            path : string
+                the path of the directory to delete
+            key : hashable
+                see `add_unlink()`
+        """
+        self._add_file_deletions(_FileDeletions.add_rmtree, _Journal.RMTREE,
+            (path,), key)
+
+    def add_to_phase(self, phase, func, *args, **kwargs):
+        """
+        Registers a cleanup like `add()` does, and sets its `Cleanup.priority`
+        to the priority of the given phase.
+
+        :Parameters:
+            phase : string
+                the name of the phase, as defined by `define_phase()`
+            func : callable
+                the function to execute
+
+        :Raises:
+            ValueError : if the phase has not been defined
+        """
+        try:
+            priority = self.phases[phase]
+        except KeyError:
+            raise ValueError("undefined phase: %r" % phase)
+        with self.lock:
+            cleanup = self._new_cleanup(func, args, kwargs)
+            cleanup.priority = priority
+            self._insert(cleanup)
+        return cleanup
+
+    def add_tagged(self, tag, func, *args, **kwargs):
+        """
+        Registers a cleanup like `add()` does, and tags it with the given tag
+        like `tag()` does.
+
+        :Parameters:
+            tag : hashable
+                the tag, such as the name of a tenant or a job
+            func : callable
+                the function to execute
+        """
+        with self.lock:
+            cleanup = self._new_cleanup(func, args, kwargs)
+            cleanup.tags = (tag,)
+            self._insert(cleanup)
+            self._index_tag(cleanup, tag)
+        return cleanup
+
+    def tag(self, cleanup, *tags):
+        """
+        Tags a registered cleanup, so that it can be executed by
+        ``run(tag=tag)`` or removed by `remove_tagged()` along with the other
+        cleanups with the same tag.  The cleanups with each tag are indexed, so
+        those operations and `len_tagged()` take time proportional to the
+        number of cleanups with the tag rather than the number of cleanups
+        registered.  The tags of a cleanup are stored in `Cleanup.tags`.
+
+        :Parameters:
+            cleanup : `Cleanup`
+                the cleanup to tag
+            tags : hashable
+                the tags
+
+        :Raises:
+            ValueError : if the cleanup is not registered with this object
+        """
+        with self.lock:
+            if not self._contains(cleanup):
+                raise ValueError("cleanup not registered: %s" % cleanup)
+            for tag in tags:
+                if tag not in cleanup.tags:
+                    cleanup.tags += (tag,)
+                    self._index_tag(cleanup, tag)
+
+    def len_tagged(self, tag):
+        """
+        Returns the number of registered cleanups with the given tag.
+        """
+        with self.lock:
+            return len(self.tags.get(tag, ()))
+
+    def remove_tagged(self, tag):
+        """
+        Unregisters all cleanups with the given tag without executing them,
+        returning the number of cleanups that were removed.
+        """
+        with self.lock:
+            cleanups = self._take_tagged(tag)
+            self._discard_taken(cleanups)
+        return len(cleanups)
+
+    def define_phase(self, phase, priority):
+        """
+        Defines a named phase of execution: a name for a `Cleanup.priority`, to
+        use with `add_to_phase()`.  For example, phases named "flush", "close"
+        and "delete" with priorities 2, 1 and 0, respectively, would cause all
+        buffers to be flushed, then all connections to be closed, then all
+        files to be deleted.
+
+        :Parameters:
+            phase : string
+                the name of the phase
+            priority : number
+                the priority of the phase
+        """
+        self.phases[phase] = priority
+
+    def add_dependency(self, cleanup, *prerequisites):
+        """
+        Declares that a registered cleanup must not be executed until some
+        other registered cleanups have finished executing, such as closing a
+        database before deleting the directory that contains it.  Once any
+        dependencies have been declared `run()` no longer executes cleanups in
+        strict reverse order of registration, but in the reverse order of
+        registration that respects the dependencies; when executing on multiple
+        threads every cleanup whose prerequisites have finished is eligible to
+        be executed concurrently.  A cleanup is executed after its prerequisites
+        regardless of whether they completed successfully, failed, or were
+        skipped by a listener; prerequisites that are removed are ignored.
+
+        :Parameters:
+            cleanup : `Cleanup`
+                the cleanup that depends on the prerequisites
+            prerequisites : `Cleanup`
+                the cleanups that must finish executing before ``cleanup`` is
+                executed
+
+        :Raises:
+            ValueError : if any of the given cleanups is not registered with
+                this object or if the dependencies would form a cycle
+        """
+        with self.lock:
+            for x in (cleanup,) + prerequisites:
+                if not self._contains(x):
+                    raise ValueError("cleanup not registered: %s" % x)
+            for prerequisite in prerequisites:
+                if self._depends_on(prerequisite, cleanup):
+                    raise ValueError("dependency of %s on %s would form a cycle"
+                        % (cleanup, prerequisite))
+            self.dependencies.setdefault(cleanup.id, []).extend(prerequisites)
+            self.bookkeeping = True
+
+    def open_journal(self, path):
+        """
+        Starts recording the paths registered with `add_unlink()` and
+        `add_rmtree()` from now on in a new journal file, as if the path had
+        been given as the ``journal`` argument of `__init__()`.  A child
+        process created by ``os.fork()`` does not record paths in the journal
+        of its parent, whose records belong to the parent, so a child that
+        registers files to delete should open its own journal with this method.
+
+        :Parameters:
+            path : string
+                the path of the journal file
+
+        :Raises:
+            ValueError : if this object already has a journal, or if the
+                journal file contains paths that were not deleted
+        """
+        if self.journal is not None:
+            raise ValueError("journal already open: %s" % self.journal.path)
+        self.journal = _Journal(path)
+        self.bookkeeping = True
+
+    def child(self):
+        """
+        Creates and returns a new `Cleanups` object that is a child scope of
+        this object.  The child is registered with this object as a single
+        cleanup, `parent_cleanup`, that runs the child, so running this object
+        runs the cleanups of all of its children that have not yet been run.
+        Running the child runs only its own cleanups (including those of its own
+        children) and then detaches it from this object by removing
+        `parent_cleanup`.  Children are independent cleanups of their parent,
+        so they may be run concurrently by `run()` when given ``max_workers``.
+        The child is not registered with the ``atexit`` module and starts out
+        with this object's listeners, `max_workers` and journal.
+        """
+        child = Cleanups(atexit_register=False, max_workers=self.max_workers)
+        child.journal = self.journal
+        child.bookkeeping = self.journal is not None
+        child.listeners = list(self.listeners)
+        child.parent = self
+        child.parent_cleanup = self.add(child.run)
+        child.parent_cleanup.name = "child scope"
+        return child
 
     def add_listener(self, listener):
         self.listeners.append(listener)
@@ -84,25 +417,231 @@ class Cleanups():
 
     def remove(self, cleanup):
         with self.lock:
-            self.cleanups.remove(cleanup)
+            if not self._discard(cleanup):
+                raise ValueError("cleanup not registered: %s" % cleanup)
 
     def clear(self):
         with self.lock:
-            self.cleanups.clear()
+            if self.journal is not None:
+                for cleanup in itertools.chain(self.back.values(),
+                        self.front.values()):
+                    self._forget(cleanup)
+            self.back = {}
+            self.front = {}
+            self.dependencies.clear()
+            self.tags.clear()
+            self.keys.clear()
+            self._atexit_unregister()
+
+    def run(self, max_workers=None, max_processes=None, deadline=None,
+            tag=None):
+        """
+        Executes and unregisters all registered cleanups, in the reverse order
+        in which they were registered.  For each cleanup the registered
+        listeners are notified via `CleanupListener.starting()` before it is
+        executed (a cleanup is skipped if any listener returns ``True``) and
+        via `CleanupListener.completed()` or `CleanupListener.failed()` after
+        it is executed.  Dependencies declared with `add_dependency()` take
+        precedence over the order of registration, and priorities (see
+        `Cleanup.priority`) take precedence over both: the cleanups are executed
+        in phases, one for each distinct priority from highest to lowest, and
+        all cleanups of a phase finish executing before any cleanup of the next
+        phase starts.  Exceptions raised by cleanups are reported to the
+        listeners and are not propagated.
 
-    def run(self):
-        (cleanups, listeners) = self._get_cleanups_and_listeners_for_execution()
-        cleanups.reverse()
-        for cleanup in cleanups:
-            self._execute_cleanup(cleanup, listeners)
+        :Parameters:
+            max_workers : int
+                the number of threads on which to execute the cleanups; if
+                ``None`` (the default) then the value of `self.max_workers` is
+                used, and if that too is ``None`` then the cleanups are
+                executed one at a time on the calling thread; when cleanups are
+                executed on multiple threads they are still *started* in
+                reverse order of registration but may complete in any order,
+                and listeners may be invoked concurrently from multiple threads
+            max_processes : int
+                the number of processes on which to execute the cleanups whose
+                `Cleanup.run_in_process` attribute is ``True``; their
+                functions and arguments must be picklable and their return
+                values and exceptions are sent back to this process to be
+                reported to the listeners; if ``None`` (the default) then all
+                cleanups are executed in this process; if ``max_workers`` is
+                ``None`` then it defaults to ``max_processes`` so that the
+                processes can be kept busy concurrently
+            deadline : float
+                the number of seconds within which this method should return;
+                cleanups that have not started by then are not started, and
+                cleanups that are still executing at that time are abandoned;
+                cleanups whose `Cleanup.best_effort` attribute is ``True`` are
+                not started once the time remaining is less than the sum of the
+                `Cleanup.timeout` attributes of the cleanups that are not best
+                effort and have not yet started, to leave time for those to
+                execute; listeners are notified via
+                `CleanupListener.abandoned()` of the cleanups that are not
+                started or are abandoned; if ``None`` (the default) then there
+                is no deadline, although cleanups are still abandoned if they
+                exceed their own `Cleanup.timeout`
+            tag : hashable
+                if not ``None`` then only the cleanups with this tag (see
+                `tag()`) are executed and unregistered, in the order in which
+                they would otherwise be executed, and the others remain
+                registered
+        """
+        self._run(max_workers, max_processes, deadline, tag, None)
+
+    def savepoint(self):
+        """
+        Returns a mark for `run_since()` and `discard_since()`: an integer that
+        is less than the `Cleanup.id` of every cleanup registered after this
+        method returns and greater than that of every cleanup registered before
+        it was invoked.  Files and directory trees registered with
+        `add_unlink()` and `add_rmtree()` after this method returns are never
+        added to a cleanup registered before it was invoked.
+        """
+        # file deletions registered from now on must not be merged into a
+        # cleanup registered before the savepoint; see _add_file_deletions()
+        mark = self.savepoint_id = next(self.cleanup_ids)
+        return mark
+
+    def run_since(self, mark, max_workers=None, max_processes=None,
+            deadline=None):
+        """
+        Executes and unregisters the cleanups registered since the given
+        savepoint, like `run()` does for all cleanups, such as to undo the
+        effects of a transaction that failed; the cleanups registered before
+        the savepoint remain registered.  Since cleanups are registered in
+        order of their IDs, those registered since the savepoint are removed
+        from the end of the registry, so this takes time
+        proportional to the number of cleanups executed rather than the number
+        registered.
+
+        :Parameters:
+            mark : int
+                the value returned by `savepoint()`
+            max_workers : int
+                see `run()`
+            max_processes : int
+                see `run()`
+            deadline : float
+                see `run()`
+        """
+        self._run(max_workers, max_processes, deadline, None, mark)
+
+    def discard_since(self, mark):
+        """
+        Unregisters the cleanups registered since the given savepoint without
+        executing them, such as to keep the resources allocated by a
+        transaction that succeeded, returning the number of cleanups that were
+        removed.  See `run_since()`.
+
+        :Parameters:
+            mark : int
+                the value returned by `savepoint()`
+        """
+        with self.lock:
+            cleanups = self._take_since(mark)
+            self._discard_taken(cleanups)
+        return len(cleanups)
+
+    def _run(self, max_workers, max_processes, deadline, tag, mark):
+        if max_processes is not None:
+            if max_processes <= 0:
+                raise ValueError("max_processes must be greater than 0: %r" %
+                    max_processes)
+            if max_workers is None:
+                max_workers = max_processes
+        if max_workers is None:
+            max_workers = self.max_workers
+        if max_workers is not None and max_workers <= 0:
+            raise ValueError("max_workers must be greater than 0: %r" %
+                max_workers)
+
+        if deadline is not None:
+            deadline += time.monotonic()
+
+        (cleanups, dependencies, listeners) = \
+            self._get_cleanups_and_listeners_for_execution(tag, mark)
+        if max_processes is None:
+            processes = None
+        else:
+            import concurrent.futures
+            processes = concurrent.futures.ProcessPoolExecutor(max_processes)
+        execution = _CleanupExecution(cleanups, listeners, processes, deadline)
+        try:
+            for phase in _group_by_priority(cleanups):
+                self._execute_cleanups(phase, dependencies, execution.execute,
+                    max_workers)
+        finally:
+            execution.close()
+            listeners.finished()
+            if (self.parent_cleanup is not None and tag is None
+                    and mark is None):
+                self._detach()
+
+    async def arun(self, max_concurrency=None, tag=None):
+        """
+        The asynchronous counterpart of `run()`, for use from a coroutine.  It
+        behaves like `run()` except that if a cleanup's function returns an
+        awaitable, such as when it is a coroutine function, then the awaitable
+        is awaited and its result is the value reported to the listeners.
+        Cleanups whose functions are not coroutine functions are invoked
+        directly on the event loop's thread.
+
+        :Parameters:
+            max_concurrency : int
+                the maximum number of cleanups to await concurrently; if
+                ``None`` (the default) then the cleanups are awaited one at a
+                time; when awaited concurrently, cleanups are still *started*
+                in the order that `run()` would execute them, but may complete
+                in any order
+            tag : hashable
+                if not ``None`` then only the cleanups with this tag are
+                executed, as for `run()`
+
+        If the task awaiting this method is cancelled, then the cleanups that
+        are executing are cancelled too, and they and the cleanups that have
+        not yet started are reported to the listeners via
+        `CleanupListener.abandoned()` before the cancellation propagates.
+        """
+        if max_concurrency is not None and max_concurrency <= 0:
+            raise ValueError("max_concurrency must be greater than 0: %r" %
+                max_concurrency)
+
+        import asyncio
+        (cleanups, dependencies, listeners) = \
+            self._get_cleanups_and_listeners_for_execution(tag)
+        # the cleanups that have not started, in order
+        not_started = dict.fromkeys(cleanups)
+        try:
+            for phase in _group_by_priority(cleanups):
+                schedule = _CleanupSchedule(phase, dependencies)
+                if max_concurrency is None:
+                    for cleanup in schedule.pop_ready():
+                        await self._aexecute_cleanup(cleanup, listeners,
+                            not_started)
+                        schedule.finished(cleanup)
+                else:
+                    await self._aexecute_schedule_concurrently(schedule,
+                        listeners, max_concurrency, not_started)
+        except asyncio.CancelledError:
+            # the cleanups have already been unregistered, so report the ones
+            # that will now never be executed rather than losing them silently
+            for cleanup in not_started:
+                if listeners.abandoned_funcs:
+                    listeners.abandoned(cleanup)
+                _CleanupExecution.skip(cleanup)
+            raise
+        finally:
+            listeners.finished()
+            if self.parent_cleanup is not None and tag is None:
+                self._detach()
 
     def __contains__(self, cleanup):
         with self.lock:
-            return cleanup in self.cleanups
+            return self._contains(cleanup)
 
     def __len__(self):
         with self.lock:
-            return len(self.cleanups)
+            return len(self.back) + len(self.front)
 
     def __call__(self, *args, **kwargs):
         return self.run(*args, **kwargs)
@@ -113,41 +652,1050 @@ class Cleanups():
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.run()
 
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.arun()
+
     def _new_cleanup(self, func, args, kwargs):
         # ASSERTION: thread must have acquired self.lock
-        self.next_cleanup_id += 1
-        return Cleanup(self, self.next_cleanup_id, func, args, kwargs)
+        return Cleanup(self, next(self.cleanup_ids), func, args, kwargs)
+
+    def _insert(self, cleanup, last=True):
+        # ASSERTION: thread must have acquired self.lock
+        if not (self.back or self.front) and self.atexit_register:
+            _atexit_instances.register(self)
+        if last:
+            self.back[cleanup.id] = cleanup
+        else:
+            self.front[cleanup.id] = cleanup
+
+    def _add_file_deletions(self, add_func, kind, paths, key=None):
+        if key is not None:
+            with self.lock:
+                if key not in self.keys:
+                    (paths, journal_ids) = self._journal_paths(kind, paths)
+                    cleanup = self._new_file_deletions(add_func, paths,
+                        journal_ids)
+                    if cleanup is not None:
+                        cleanup.key = key
+                        self._insert(cleanup)
+                        self.keys[key] = cleanup
+                        self.bookkeeping = True
+            return
+
+        (paths, journal_ids) = self._journal_paths(kind, paths)
+
+        with self.lock:
+            # add to the most-recently-added cleanup if it deletes files, which
+            # leaves the order of execution unchanged
+            back = self.back
+            cleanup = back[next(reversed(back))] if back else None
+            if (cleanup is not None and isinstance(cleanup.func, _FileDeletions)
+                    and cleanup.func.accepts(add_func)
+                    and cleanup.id > self.fork_id
+                    and cleanup.id > self.savepoint_id
+                    and cleanup.key is None):
+                file_deletions = cleanup.func
+                for path in paths:
+                    add_func(file_deletions, path)
+                file_deletions.journal_ids.extend(journal_ids)
+                return
+
+            cleanup = self._new_file_deletions(add_func, paths, journal_ids)
+            if cleanup is not None:
+                self._insert(cleanup)
+
+    def _journal_paths(self, kind, paths):
+        # journal the paths before registering their deletion, so that there is
+        # no window in which a crash would leave them neither deleted nor
+        # reaped; returns the paths and the IDs of their journal records
+        if self.journal is None:
+            return (paths, ())
+        journal = self.journal
+        paths = list(paths)
+        return (paths, [journal.append(kind, path) for path in paths])
+
+    def _new_file_deletions(self, add_func, paths, journal_ids):
+        # returns a new cleanup that deletes the given paths, or None if there
+        # are none
+        file_deletions = _FileDeletions(self)
+        for path in paths:
+            add_func(file_deletions, path)
+        if not (file_deletions.unlinks or file_deletions.rmtrees):
+            return None
+        file_deletions.journal_ids.extend(journal_ids)
+        cleanup = self._new_cleanup(file_deletions, (), {})
+        cleanup.name = "delete files"
+        return cleanup
+
+    def _after_fork_in_child(self):
+        # invoked in the child process after a fork, where no other threads
+        # exist, so the locks are replaced rather than acquired since they may
+        # have been held by threads of the parent process at the time of the
+        # fork; the journal belongs to the parent, and the cleanups registered
+        # so far are marked as inherited by consuming an ID
+        self.lock = _thread.allocate_lock()
+        self.journal = None
+        self.fork_id = next(self.cleanup_ids)
+
+    def _discard(self, cleanup):
+        """
+        Removes a cleanup, returning whether it was registered.
+        """
+        # ASSERTION: thread must have acquired self.lock
+        # Cleanup.id is only unique within a single Cleanups object, so the
+        # identity of the value is checked too
+        try:
+            id = cleanup.id
+        except AttributeError:
+            return False
+        if self.back.get(id) is cleanup:
+            del self.back[id]
+        elif self.front.get(id) is cleanup:
+            del self.front[id]
+        else:
+            return False
+        if self.bookkeeping:
+            self.dependencies.pop(id, None)
+            self._unindex(cleanup)
+            if self.journal is not None:
+                self._forget(cleanup)
+        if not (self.back or self.front):
+            self._atexit_unregister()
+        return True
+
+    def _index_tag(self, cleanup, tag):
+        # ASSERTION: thread must have acquired self.lock
+        index = self.tags.get(tag)
+        if index is None:
+            index = self.tags[tag] = {}
+        index[cleanup.id] = cleanup
+        self.bookkeeping = True
+
+    def _unindex(self, cleanup, skip_tag=None):
+        # removes a cleanup from the indexes of tags and keys
+        # ASSERTION: thread must have acquired self.lock
+        key = cleanup.key
+        if key is not None and self.keys.get(key) is cleanup:
+            del self.keys[key]
+        for tag in cleanup.tags:
+            if tag != skip_tag:
+                index = self.tags.get(tag)
+                if index is not None:
+                    index.pop(cleanup.id, None)
+                    if not index:
+                        del self.tags[tag]
+
+    def _take_tagged(self, tag):
+        """
+        Unregisters the cleanups with the given tag, returning them in the
+        order in which `run()` would execute them.
+        """
+        # ASSERTION: thread must have acquired self.lock
+        index = self.tags.pop(tag, None)
+        if not index:
+            return []
+        backs = []
+        fronts = []
+        for cleanup in index.values():
+            if self.back.pop(cleanup.id, None) is not None:
+                backs.append(cleanup)
+            elif self.front.pop(cleanup.id, None) is not None:
+                fronts.append(cleanup)
+            else:
+                continue
+            self._unindex(cleanup, tag)
+        import operator
+        key = operator.attrgetter("id")
+        backs.sort(key=key, reverse=True)
+        fronts.sort(key=key)
+        backs.extend(fronts)
+        return backs
+
+    def _take_since(self, mark):
+        """
+        Unregisters the cleanups registered since the given savepoint,
+        returning them in the order in which `run()` would execute them.
+        """
+        # ASSERTION: thread must have acquired self.lock
+        # the dicts are sorted by ID, so pop from their ends
+        cleanups = []
+        back = self.back
+        while back and next(reversed(back)) > mark:
+            cleanups.append(back.popitem()[1])
+        fronts = []
+        front = self.front
+        while front and next(reversed(front)) > mark:
+            fronts.append(front.popitem()[1])
+        fronts.reverse()
+        cleanups.extend(fronts)
+        if self.tags or self.keys:
+            for cleanup in cleanups:
+                if cleanup.tags or cleanup.key is not None:
+                    self._unindex(cleanup)
+        return cleanups
+
+    def _take_dependencies(self, cleanups):
+        """
+        Removes the dependencies of the given cleanups from
+        `self.dependencies`, returning them in a new dict.
+        """
+        # ASSERTION: thread must have acquired self.lock
+        dependencies = {}
+        if self.dependencies:
+            for cleanup in cleanups:
+                prerequisites = self.dependencies.pop(cleanup.id, None)
+                if prerequisites is not None:
+                    dependencies[cleanup.id] = prerequisites
+        return dependencies
+
+    def _discard_taken(self, cleanups):
+        # completes the removal of cleanups that were taken from the registry
+        # without executing them
+        # ASSERTION: thread must have acquired self.lock
+        for cleanup in cleanups:
+            self.dependencies.pop(cleanup.id, None)
+            if self.journal is not None:
+                self._forget(cleanup)
+        if cleanups:
+            self._atexit_unregister()
+
+    def _forget(self, cleanup):
+        # records in the journal that the paths of an unregistered cleanup no
+        # longer need to be deleted
+        if isinstance(cleanup.func, _FileDeletions):
+            cleanup.func.forget()
+
+    def _detach(self):
+        # the parent may have already unregistered parent_cleanup because it is
+        # the one running this object
+        cleanup = self.parent_cleanup
+        self.parent_cleanup = None
+        with self.parent.lock:
+            self.parent._discard(cleanup)
+
+    def _atexit_unregister(self):
+        # unregisters this object if it has no registered cleanups
+        # ASSERTION: thread must have acquired self.lock
+        if self.atexit_register and not (self.back or self.front):
+            _atexit_instances.unregister(self)
 
-    def _get_cleanups_and_listeners_for_execution(self):
+    def _contains(self, cleanup):
+        # ASSERTION: thread must have acquired self.lock
+        # Cleanup.id is only unique within a single Cleanups object, so the
+        # identity of the value is checked too
+        try:
+            id = cleanup.id
+        except AttributeError:
+            return False
+        return self.back.get(id) is cleanup or self.front.get(id) is cleanup
+
+    def _depends_on(self, cleanup, prerequisite):
+        # ASSERTION: thread must have acquired self.lock
+        visited = set()
+        stack = [cleanup]
+        while stack:
+            x = stack.pop()
+            if x is prerequisite:
+                return True
+            if x.id not in visited:
+                visited.add(x.id)
+                stack.extend(self.dependencies.get(x.id, ()))
+        return False
+
+    def _get_cleanups_and_listeners_for_execution(self, tag=None, mark=None):
+        # returns the cleanups in the order in which they are to be executed;
+        # if a tag is given then only the cleanups with that tag, and if a mark
+        # is given then only the cleanups registered since that savepoint
         with self.lock:
-            cleanups = self.cleanups
-            self.cleanups = []
+            if tag is not None:
+                cleanups = self._take_tagged(tag)
+                dependencies = self._take_dependencies(cleanups)
+            elif mark is not None:
+                cleanups = self._take_since(mark)
+                dependencies = self._take_dependencies(cleanups)
+            else:
+                (cleanups, dependencies) = self._take_all()
+            if self.fork_id:
+                # drop the cleanups inherited from the parent process
+                cleanups = [x for x in cleanups
+                    if x.id > self.fork_id or x.inheritable]
             listeners = tuple(self.listeners)
+            self._atexit_unregister()
 
         with self.global_lock:
             global_listeners = tuple(self.global_listeners)
 
-        listeners = global_listeners + listeners
-        listeners = _CleanupListenerNotifier(self, listeners)
+        # the notifier is created for each run, rather than re-used, since the
+        # methods of a listener may be replaced between runs
+        notifier = _CleanupListenerNotifier(self, global_listeners, listeners)
+        return (cleanups, dependencies, notifier)
+
+    def _take_all(self):
+        """
+        Unregisters all cleanups, returning them in the order in which `run()`
+        would execute them, along with their dependencies.
+        """
+        # ASSERTION: thread must have acquired self.lock
+        cleanups = list(reversed(self.back.values()))
+        cleanups.extend(self.front.values())
+        self.back = {}
+        self.front = {}
+        dependencies = self.dependencies
+        self.dependencies = {}
+        self.tags = {}
+        self.keys = {}
+        return (cleanups, dependencies)
+
+    def _execute_cleanups(self, cleanups, dependencies, execute, max_workers):
+        # execute is a function that executes a single Cleanup
+        if dependencies:
+            schedule = _CleanupSchedule(cleanups, dependencies)
+            if max_workers is None:
+                self._execute_schedule(schedule, execute)
+            else:
+                self._execute_schedule_in_threads(schedule, execute,
+                    max_workers)
+        elif max_workers is None:
+            for cleanup in cleanups:
+                execute(cleanup)
+        else:
+            self._execute_cleanups_in_threads(cleanups, execute, max_workers)
+
+    def _execute_cleanups_in_threads(self, cleanups, execute, max_workers):
+        import concurrent.futures
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+        with executor:
+            for cleanup in cleanups:
+                executor.submit(execute, cleanup)
+
+    def _execute_schedule(self, schedule, execute):
+        for cleanup in schedule.pop_ready():
+            execute(cleanup)
+            schedule.finished(cleanup)
+
+    def _execute_schedule_in_threads(self, schedule, execute, max_workers):
+        import concurrent.futures
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+        with executor:
+            running = {}
+            while True:
+                for cleanup in schedule.pop_ready():
+                    future = executor.submit(execute, cleanup)
+                    running[future] = cleanup
+                if not running:
+                    break
+                (done, not_done) = concurrent.futures.wait(running,
+                    return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    schedule.finished(running.pop(future))
+
+    async def _aexecute_schedule_concurrently(self, schedule, listeners,
+            max_concurrency, not_started):
+        import asyncio
+        running = {}
+        try:
+            while True:
+                for cleanup in schedule.pop_ready():
+                    task = asyncio.ensure_future(
+                        self._aexecute_cleanup(cleanup, listeners,
+                            not_started))
+                    running[task] = cleanup
+                    if len(running) >= max_concurrency:
+                        break
+                if not running:
+                    break
+                (done, pending) = await asyncio.wait(running,
+                    return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    schedule.finished(running.pop(task))
+        finally:
+            for task in running:
+                task.cancel()
+            if running:
+                # let the cancelled cleanups report themselves as abandoned
+                await asyncio.wait(running)
+
+    async def _aexecute_cleanup(self, cleanup, listeners, not_started):
+        import asyncio
+        import inspect
+        not_started.pop(cleanup, None)
+        if listeners.starting_funcs and listeners.starting(cleanup):
+            _CleanupExecution.skip(cleanup)
+            return
+        try:
+            retval = cleanup.run()
+            if inspect.isawaitable(retval):
+                retval = await retval
+        except asyncio.CancelledError:
+            if listeners.abandoned_funcs:
+                listeners.abandoned(cleanup)
+            raise
+        except:
+            if listeners.failed_funcs:
+                listeners.failed(cleanup, sys.exc_info())
+        else:
+            if listeners.completed_funcs:
+                listeners.completed(cleanup, retval)
+
+################################################################################
+
+def _group_by_priority(cleanups):
+    """
+    Splits a list of `Cleanup` objects into lists of cleanups with the same
+    `Cleanup.priority`, preserving their relative order, and returns those
+    lists in order of decreasing priority.
+    """
+    phases = {}
+    for cleanup in cleanups:
+        # read the options directly, rather than via the property, since this
+        # is done for every cleanup executed
+        priority = cleanup._options.priority
+        phase = phases.get(priority)
+        if phase is None:
+            phase = phases[priority] = []
+        phase.append(cleanup)
+    if len(phases) <= 1:
+        return [cleanups]
+    return [phases[priority] for priority in sorted(phases, reverse=True)]
+
+################################################################################
+
+class _FileDeletions():
+    """
+    The function of a cleanup that deletes a batch of files and directory
+    trees registered via `Cleanups.add_unlink()` and `Cleanups.add_rmtree()`.
+    """
+
+    CHUNK_SIZE = 1000
+    """The maximum number of files in one directory to delete as a single unit
+    of work when deleting files on multiple threads"""
+
+    def __init__(self, cleanups):
+        """
+        :Parameters:
+            cleanups : `Cleanups`
+                the ``Cleanups`` object whose `Cleanups.max_workers` attribute
+                specifies the number of threads on which to delete files
+        """
+        self.cleanups = cleanups
+        self.unlinks = {}
+        self.rmtrees = {}
+        self.journal_ids = []
+
+    def add_unlink(self, path):
+        (dirname, basename) = os.path.split(os.fspath(path))
+        names = self.unlinks.get(dirname)
+        if names is None:
+            names = self.unlinks[dirname] = {}
+        names[basename] = None
+
+    def add_rmtree(self, path):
+        self.rmtrees[os.fspath(path)] = None
+
+    def accepts(self, add_func):
+        """
+        Returns whether paths may be added to this object with the given
+        function, `add_unlink()` or `add_rmtree()`, without changing the order
+        of deletion relative to the paths already added.  Since files are
+        deleted grouped by directory before directory trees are deleted, an
+        object may contain only files or only directory trees.
+        """
+        if add_func is _FileDeletions.add_unlink:
+            return not self.rmtrees
+        return not self.unlinks
+
+    def forget(self):
+        """
+        Records tombstones in the journal of `self.cleanups` for the paths of
+        this object, if they were journaled.
+        """
+        journal_ids = self.journal_ids
+        if journal_ids:
+            self.journal_ids = []
+            # the journal is None in a child process that inherited this object
+            journal = self.cleanups.journal
+            if journal is not None:
+                journal.forget(journal_ids)
+
+    def __call__(self):
+        try:
+            self.delete()
+        finally:
+            self.forget()
+
+    def delete(self):
+        errors = []
+        work = []
+        for (dirname, names) in reversed(self.unlinks.items()):
+            names = list(reversed(names))
+            for i in range(0, len(names), self.CHUNK_SIZE):
+                work.append((dirname, names[i:i + self.CHUNK_SIZE]))
+
+        max_workers = self.cleanups.max_workers
+        if max_workers is None or len(work) <= 1:
+            for (dirname, names) in work:
+                self.unlink(dirname, names, errors)
+        else:
+            import concurrent.futures
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+            with executor:
+                for (dirname, names) in work:
+                    executor.submit(self.unlink, dirname, names, errors)
+
+        if self.rmtrees:
+            import shutil
+        for path in reversed(self.rmtrees):
+            try:
+                shutil.rmtree(path)
+            except OSError as e:
+                errors.append((path, e))
 
-        return (cleanups, listeners)
+        if errors:
+            raise FileDeletionError(errors)
 
-    def _execute_cleanup(self, cleanup, listeners):
-        if not listeners.starting(cleanup):
+    @staticmethod
+    def unlink(dirname, names, errors):
+        """
+        Deletes files in a directory, appending a tuple ``(path, exception)``
+        to the given list for each file that could not be deleted.
+        """
+        dir_fd = None
+        if os.unlink in os.supports_dir_fd:
             try:
-                retval = cleanup.run()
+                dir_fd = os.open(dirname or os.curdir,
+                    os.O_RDONLY | getattr(os, "O_DIRECTORY", 0))
+            except OSError:
+                pass # fall back to deleting each file by its full path
+
+        try:
+            for name in names:
+                try:
+                    if dir_fd is None:
+                        os.unlink(os.path.join(dirname, name))
+                    else:
+                        os.unlink(name, dir_fd=dir_fd)
+                except OSError as e:
+                    errors.append((os.path.join(dirname, name), e))
+        finally:
+            if dir_fd is not None:
+                os.close(dir_fd)
+
+################################################################################
+
+class _Journal():
+    """
+    An append-only log of the files and directory trees registered for deletion
+    via `Cleanups.add_unlink()` and `Cleanups.add_rmtree()` that have not yet
+    been deleted, so that `reap()` can delete them if the process is killed
+    before executing its cleanups.  The log is written to a shared memory
+    mapping of the file and is never explicitly flushed, so appending a record
+    costs a memory copy rather than a system call; the operating system writes
+    the mapping to the file even if the process is killed, but not if the
+    operating system itself crashes.
+
+    The file starts with `MAGIC` and is followed by records, each of which is
+    a `RECORD` header ``(kind, id, length)`` followed by ``length`` bytes of
+    path.  A record whose kind is `TOMBSTONE` cancels the earlier record with
+    the same ID.  The kind byte of a record is written after the rest of it,
+    and the file is zero-filled past the last record, so a record that was
+    partially written when the process was killed is never read.  Whenever no
+    records remain live the log is emptied so that it does not grow without
+    bound.
+    """
+
+    MAGIC = b"pycleanups journal 1\n"
+
+    RECORD = "<BQI"
+    """The ``struct`` format of the header of a record"""
+
+    RECORD_SIZE = 13
+
+    UNLINK = ord("U")
+    RMTREE = ord("R")
+    TOMBSTONE = ord("T")
+
+    INITIAL_SIZE = 64 * 1024
+
+    def __init__(self, path):
+        """
+        Opens a journal file, creating it if it does not exist.
+
+        :Parameters:
+            path : string
+                the path of the journal file
+
+        :Raises:
+            ValueError : if the file exists and is not a journal or still has
+                live records, which must be reaped first
+        """
+        self.path = os.fspath(path)
+        self.lock = _thread.allocate_lock()
+        self.ids = itertools.count(1)
+        self.live = 0
+
+        self.file = open(self.path, "a+b")
+        try:
+            self.file.seek(0)
+            data = self.file.read()
+            if data and self.read(data):
+                raise ValueError("journal has cleanups pending; reap it first: "
+                    "%s" % self.path)
+            self.file.truncate(0)
+            self.file.truncate(self.INITIAL_SIZE)
+            import mmap
+            self.map = mmap.mmap(self.file.fileno(), self.INITIAL_SIZE)
+        except:
+            self.file.close()
+            raise
+        self.map[:len(self.MAGIC)] = self.MAGIC
+        self.end = len(self.MAGIC)
+
+    def append(self, kind, path):
+        """
+        Appends a record for a path to delete, returning the ID of the record.
+        """
+        data = os.fsencode(os.path.abspath(path))
+        with self.lock:
+            id = next(self.ids)
+            self.write(kind, id, data)
+            self.live += 1
+        return id
+
+    def forget(self, ids):
+        """
+        Cancels the records with the given IDs.
+        """
+        with self.lock:
+            self.live -= len(ids)
+            if self.live:
+                for id in ids:
+                    self.write(self.TOMBSTONE, id, b"")
+            else:
+                self.reset()
+
+    def write(self, kind, id, data):
+        # ASSERTION: thread must have acquired self.lock
+        start = self.end
+        end = start + self.RECORD_SIZE + len(data)
+        if end >= len(self.map):
+            # leave at least one zero byte after the last record
+            self.grow(end + 1)
+        import struct
+        struct.pack_into(self.RECORD, self.map, start, 0, id, len(data))
+        self.map[start + self.RECORD_SIZE:end] = data
+        self.map[start] = kind
+        self.end = end
+
+    def grow(self, size):
+        # ASSERTION: thread must have acquired self.lock
+        size = max(size, len(self.map) * 2)
+        self.map.close()
+        self.file.truncate(size)
+        import mmap
+        self.map = mmap.mmap(self.file.fileno(), size)
+
+    def reset(self):
+        # ASSERTION: thread must have acquired self.lock
+        start = len(self.MAGIC)
+        # zeroing the first kind byte empties the log in a single write
+        self.map[start] = 0
+        self.map[start:self.end] = bytes(self.end - start)
+        self.end = start
+
+    def close(self):
+        with self.lock:
+            self.map.close()
+            self.file.close()
+
+    @classmethod
+    def read(cls, data):
+        """
+        Parses the contents of a journal file, returning a dict that maps the
+        ID of each live record to a tuple ``(kind, path)``, in the order in
+        which they were appended.
+
+        :Raises:
+            ValueError : if the data is not that of a journal file
+        """
+        if not data.startswith(cls.MAGIC):
+            raise ValueError("not a cleanups journal")
+        records = {}
+        offset = len(cls.MAGIC)
+        import struct
+        while offset + cls.RECORD_SIZE <= len(data):
+            (kind, id, length) = struct.unpack_from(cls.RECORD, data, offset)
+            offset += cls.RECORD_SIZE
+            if kind == cls.TOMBSTONE:
+                records.pop(id, None)
+            elif kind in (cls.UNLINK, cls.RMTREE) and \
+                    offset + length <= len(data):
+                records[id] = (kind, os.fsdecode(data[offset:offset + length]))
+                offset += length
+            else:
+                break
+        return records
+
+def reap(journal):
+    """
+    Deletes the files and directory trees recorded in a journal file by a
+    `Cleanups` object created with that ``journal`` whose process was killed
+    before executing its cleanups, then deletes the journal file itself, and
+    returns the number of paths that were recorded in it.  Files and
+    directories that no longer exist are ignored.  This is the function invoked
+    by ``python -m cleanups reap <journal>``.
+
+    :Parameters:
+        journal : string
+            the path of the journal file
+
+    :Raises:
+        ValueError : if the file is not a journal file
+        FileDeletionError : if any of the paths could not be deleted, in which
+            case the journal file is not deleted
+    """
+    with open(journal, "rb") as f:
+        records = _Journal.read(f.read())
+    file_deletions = _FileDeletions(Cleanups(atexit_register=False))
+    for (kind, path) in records.values():
+        if kind == _Journal.UNLINK:
+            file_deletions.add_unlink(path)
+        else:
+            file_deletions.add_rmtree(path)
+    try:
+        file_deletions.delete()
+    except FileDeletionError as e:
+        errors = [(path, exception) for (path, exception) in e.errors
+            if not isinstance(exception, FileNotFoundError)]
+        if errors:
+            raise FileDeletionError(errors)
+    os.unlink(journal)
+    return len(records)
+
+################################################################################
+
+class _CleanupSchedule():
+    """
+    Orders the execution of cleanups that have dependencies between them.  Of
+    the cleanups whose prerequisites have all finished, the one that comes
+    first in the given list is always the next one to be executed.
+    """
+
+    def __init__(self, cleanups, dependencies):
+        """
+        :Parameters:
+            cleanups : list
+                the `Cleanup` objects to execute, in the order in which they
+                would be executed if there were no dependencies
+            dependencies : dict
+                maps the ID of a `Cleanup` to a list of the `Cleanup` objects
+                that must finish before it is executed; prerequisites that are
+                not in ``cleanups`` are ignored
+        """
+        self.cleanups = cleanups
+        self.waiting = {}
+        self.dependents = {}
+
+        ranks = {cleanup.id: rank for (rank, cleanup) in enumerate(cleanups)}
+        for (id, prerequisites) in dependencies.items():
+            rank = ranks.get(id)
+            if rank is None:
+                continue
+            for prerequisite in prerequisites:
+                if prerequisite.id in ranks:
+                    self.dependents.setdefault(prerequisite.id, []).append(rank)
+                    self.waiting[rank] = self.waiting.get(rank, 0) + 1
+
+        # a sorted list is a valid heap, so no need to heapify()
+        self.ready = [rank for rank in range(len(cleanups))
+            if rank not in self.waiting]
+
+    def pop_ready(self):
+        """
+        Generates the cleanups that are ready to be executed, in order; the
+        generator stops when there are no more ready cleanups, but may be
+        invoked again after `finished()` makes more cleanups ready.
+        """
+        import heapq
+        while self.ready:
+            yield self.cleanups[heapq.heappop(self.ready)]
+
+    def finished(self, cleanup):
+        """
+        Records that a cleanup that was returned from `pop_ready()` has finished
+        executing, making ready the cleanups that were waiting only for it.
+        """
+        for rank in self.dependents.pop(cleanup.id, ()):
+            count = self.waiting.pop(rank) - 1
+            if count:
+                self.waiting[rank] = count
+            else:
+                import heapq
+                heapq.heappush(self.ready, rank)
+
+################################################################################
+
+class _CleanupExecution():
+    """
+    The state of a single invocation of `Cleanups.run()`, whose `execute()`
+    method executes a single cleanup and notifies the listeners.
+    """
+
+    def __init__(self, cleanups, listeners, processes=None, deadline=None):
+        """
+        :Parameters:
+            cleanups : list
+                the `Cleanup` objects that will be executed
+            listeners : `_CleanupListenerNotifier`
+                the listeners to notify
+            processes : concurrent.futures.ProcessPoolExecutor
+                the executor on which to execute the cleanups whose
+                `Cleanup.run_in_process` is ``True``, or ``None``
+            deadline : float
+                the value of ``time.monotonic()`` by which the execution of
+                the cleanups should be complete, or ``None``
+        """
+        self.listeners = listeners
+        self.processes = processes
+        self.deadline = deadline
+        self.abandoned = False
+        self.lock = _thread.allocate_lock()
+        self.watchdog = _Watchdog()
+        self.futures = []
+
+        # the time to reserve for cleanups that are not best effort
+        self.reserve = 0
+        if deadline is not None:
+            for cleanup in cleanups:
+                if cleanup.timeout is not None and not cleanup.best_effort:
+                    self.reserve += cleanup.timeout
+
+    def execute(self, cleanup):
+        listeners = self.listeners
+        # read the options directly, rather than via the properties of the
+        # cleanup, since this is the hot path of run()
+        options = cleanup._options
+        timeout = options.timeout
+
+        if self.deadline is not None:
+            with self.lock:
+                if timeout is not None and not options.best_effort:
+                    self.reserve -= timeout
+                remaining = self.deadline - time.monotonic()
+                too_late = remaining <= 0 or (options.best_effort and
+                    remaining <= self.reserve)
+                if too_late:
+                    self.abandon(cleanup)
+            if too_late:
+                self.skip(cleanup)
+                return
+            if timeout is None or timeout > remaining:
+                timeout = remaining
+
+        if listeners.starting_funcs and listeners.starting(cleanup):
+            self.skip(cleanup)
+            return
+
+        if self.processes is not None and options.run_in_process:
+            import functools
+            func = functools.partial(self.run_in_process, cleanup)
+        else:
+            func = cleanup.run
+
+        if timeout is None:
+            try:
+                retval = func()
             except:
-                listeners.failed(cleanup, sys.exc_info())
+                exc_info = sys.exc_info()
             else:
-                listeners.completed(cleanup, retval)
+                exc_info = None
+        else:
+            (finished, retval, exc_info) = self.watchdog.call(func, timeout)
+            if not finished:
+                self.abandon(cleanup)
+                return
+
+        if exc_info is not None:
+            if listeners.failed_funcs:
+                listeners.failed(cleanup, exc_info)
+        elif listeners.completed_funcs:
+            listeners.completed(cleanup, retval)
+
+    def run_in_process(self, cleanup):
+        future = self.processes.submit(cleanup.func, *cleanup.args,
+            **cleanup.kwargs)
+        with self.lock:
+            self.futures.append(future)
+        return future.result()
+
+    def abandon(self, cleanup):
+        self.abandoned = True
+        if self.listeners.abandoned_funcs:
+            self.listeners.abandoned(cleanup)
+
+    @staticmethod
+    def skip(cleanup):
+        """
+        Completes the removal of a cleanup that was unregistered to be
+        executed but will never start, by cancelling the journal records of
+        its paths, if any, since `reap()` would otherwise delete them.
+        """
+        cleanup.cleanups._forget(cleanup)
+
+    def close(self):
+        """
+        Releases the threads and processes used by the execution, once all of
+        the cleanups have been executed or abandoned.
+        """
+        self.watchdog.close()
+        if self.processes is not None:
+            if self.abandoned:
+                # don't wait for processes executing abandoned cleanups, nor
+                # for those yet to start them; shutdown(cancel_futures=True)
+                # would do the latter, but requires Python 3.9
+                with self.lock:
+                    for future in self.futures:
+                        future.cancel()
+            self.processes.shutdown(wait=not self.abandoned)
+
+################################################################################
+
+class _Watchdog():
+    """
+    Invokes functions on daemon threads, giving up on those that do not return
+    within a given timeout.  A thread is reused for subsequent functions unless
+    a function invoked on it timed out, in which case it is left to finish (or
+    not) on its own and a new thread is created.  Since the threads are daemon
+    threads they do not prevent the interpreter from exiting, but the idle
+    ones must be stopped with `close()` once the watchdog is no longer needed.
+    """
+
+    def __init__(self):
+        self.idle_workers = []
+        self.lock = _thread.allocate_lock()
+
+    def call(self, func, timeout):
+        """
+        Invokes a function with no arguments on another thread, waiting at most
+        the given number of seconds for it to return; returns a tuple
+        ``(finished, retval, exc_info)``, where ``finished`` is ``False`` if the
+        function did not return in time, and ``exc_info`` is the result of
+        ``sys.exc_info()`` if it raised an exception or ``None`` otherwise.
+        """
+        with self.lock:
+            worker = self.idle_workers.pop() if self.idle_workers else None
+        if worker is None:
+            worker = _WatchdogWorker()
+
+        result = worker.call(func, timeout)
+        if result[0]:
+            with self.lock:
+                self.idle_workers.append(worker)
+        return result
+
+    def close(self):
+        """
+        Stops the threads of the idle workers, waiting for them to exit.  This
+        must not be invoked while `call()` is executing.
+        """
+        with self.lock:
+            workers = self.idle_workers
+            self.idle_workers = []
+        for worker in workers:
+            worker.requests.put(None)
+        for worker in workers:
+            worker.thread.join()
+
+class _WatchdogWorker():
+    """
+    A daemon thread that invokes functions on behalf of a `_Watchdog`.
+    """
+
+    def __init__(self):
+        import queue
+        import threading
+        self.requests = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self.main,
+            name="cleanups-watchdog", daemon=True)
+        self.thread.start()
+
+    def call(self, func, timeout):
+        import threading
+        request = [func, threading.Event(), None, None]
+        self.requests.put(request)
+        if not request[1].wait(timeout):
+            # the thread exits once func() returns, if it ever does
+            self.requests.put(None)
+            return (False, None, None)
+        return (True, request[2], request[3])
+
+    def main(self):
+        while True:
+            request = self.requests.get()
+            if request is None:
+                break
+            try:
+                request[2] = request[0]()
+            except:
+                request[3] = sys.exc_info()
+            request[1].set()
 
 ################################################################################
 
+class _CleanupOptions():
+    """
+    The attributes of a `Cleanup` that most cleanups leave at their default
+    values, such as `Cleanup.priority` and `Cleanup.timeout`, which are stored
+    in an object of this class rather than in slots of the ``Cleanup`` itself.
+    A ``Cleanup`` shares `_DEFAULT_OPTIONS` until one of them is assigned, so
+    they cost a single slot in a ``Cleanup`` that uses none of them.
+    """
+
+    __slots__ = ("priority", "run_in_process", "timeout", "best_effort",
+        "inheritable", "tags", "key")
+
+    def __init__(self):
+        self.priority = 0
+        self.run_in_process = False
+        self.timeout = None
+        self.best_effort = False
+        self.inheritable = False
+        self.tags = ()
+        self.key = None
+
+_DEFAULT_OPTIONS = _CleanupOptions()
+"""The `_CleanupOptions` shared by all `Cleanup` objects whose options have
+their default values; it must never be modified"""
+
+def _option(name, doc):
+    """
+    Returns a property of `Cleanup` for the attribute of its `_CleanupOptions`
+    with the given name, which gives the ``Cleanup`` its own
+    ``_CleanupOptions`` when the attribute is assigned.
+    """
+    def get(cleanup):
+        return getattr(cleanup._options, name)
+    def set(cleanup, value):
+        options = cleanup._options
+        if options is _DEFAULT_OPTIONS:
+            options = cleanup._options = _CleanupOptions()
+        setattr(options, name, value)
+    return property(get, set, doc=doc)
+
 class Cleanup():
     """
-    Stores information about a cleanup operation.
+    Stores information about a cleanup operation.  Since a ``Cleanup`` is
+    created for every registered cleanup, its attributes are stored in slots
+    rather than an instance dict to minimize its memory footprint, and those
+    that most cleanups never change are stored in a shared `_CleanupOptions`
+    until they are changed.
     """
 
+    __slots__ = ("cleanups", "id", "func", "args", "kwargs", "name",
+        "_options", "__weakref__")
+
     def __init__(self, cleanups, id, func, args, kwargs):
         """
         Initializes a new instance of ``Cleanup``.
@@ -162,11 +1710,14 @@ class Cleanup():
                 the function to execute
             args : iterable
                 the positional arguments to specify when invoking ``func``;
-                will be converted to a tuple using the ``tuple()`` function and
-                the tuple will be stored in the attributes of this object
+                will be converted to a tuple using the ``tuple()`` function
+                (unless it is already a tuple) and the tuple will be stored in
+                the attributes of this object
             kwargs : dict
                 will be converted to a dict using the ``dict()`` function and
-                the dict will be stored in the attributes of this object
+                the dict will be stored in the attributes of this object; if
+                empty, a shared empty dict is stored instead, which must not be
+                modified
         """
 
         self.cleanups = cleanups
@@ -180,11 +1731,11 @@ class Cleanup():
         """A callable whose value is the function of this cleanup; initialized
         to the value of the ``func`` parameter in `__init__()`"""
 
-        self.args = tuple(args)
+        self.args = args if type(args) is tuple else tuple(args)
         """A tuple whose value is the positional argument to specify to `func`;
         initialized to the value of the ``args`` parameter in `__init__()`"""
 
-        self.kwargs = dict(kwargs)
+        self.kwargs = dict(kwargs) if kwargs else _NO_KWARGS
         """A dict whose value is the keyword argument to specify to `func`;
         initialized to the value of the ``kwargs`` parameter in `__init__()`"""
 
@@ -193,6 +1744,52 @@ class Cleanup():
         ``None`` in `__init__()`; it may be assigned to another value after
         creation for debugging purposes"""
 
+        self._options = _DEFAULT_OPTIONS
+
+    priority = _option("priority",
+        """A number whose value is the priority of this cleanup; cleanups with
+        higher priorities are executed by `Cleanups.run()` before those with
+        lower priorities, regardless of the order of registration; ``0`` by
+        default; it may be assigned to another value after creation, or set by
+        `Cleanups.add_to_phase()`""")
+
+    run_in_process = _option("run_in_process",
+        """A bool whose value is whether to execute this cleanup in a separate
+        process when `Cleanups.run()` is given ``max_processes``, such as for
+        CPU-bound cleanups that would otherwise contend for the GIL; ``False``
+        by default; it may be assigned to ``True`` after creation if `func`,
+        `args` and `kwargs` are picklable""")
+
+    timeout = _option("timeout",
+        """A number whose value is the number of seconds that `Cleanups.run()`
+        waits for this cleanup to complete before abandoning it, or ``None``
+        to wait indefinitely (unless a deadline is given to `Cleanups.run()`);
+        ``None`` by default; it may be assigned to another value after
+        creation""")
+
+    best_effort = _option("best_effort",
+        """A bool whose value is whether this cleanup may be skipped by
+        `Cleanups.run()` to leave time before its deadline for cleanups that
+        are not best effort; ``False`` by default; it may be assigned to
+        ``True`` after creation""")
+
+    inheritable = _option("inheritable",
+        """A bool whose value is whether this cleanup is executed by child
+        processes created by ``os.fork()`` after it was registered, in addition
+        to this process; if ``False`` then it is executed only by the process
+        that registered it, such as to delete temporary files only once;
+        ``False`` by default; it may be assigned to ``True`` after creation""")
+
+    tags = _option("tags",
+        """A tuple whose value is the tags of this cleanup; an empty tuple by
+        default; it must not be assigned after creation, since tags are indexed
+        by `Cleanups.tag()` and `Cleanups.add_tagged()`""")
+
+    key = _option("key",
+        """The key of this cleanup, or ``None`` if it has no key; ``None`` by
+        default; it must not be assigned after creation, since keys are indexed
+        by `Cleanups.add_keyed()`""")
+
     def run(self):
         """
         Executes this cleanup.  Invokes `self.func` with positional arguments
@@ -284,6 +1881,35 @@ class CleanupListener():
         """
         pass
 
+    def abandoned(self, cleanups, cleanup):
+        """
+        Invoked instead of `completed()` or `failed()` when a cleanup does not
+        complete within its `Cleanup.timeout` or before the deadline given to
+        `Cleanups.run()`, in which case it continues executing on a daemon
+        thread but its outcome is ignored.  Also invoked, without `starting()`
+        being invoked first, for a cleanup that is not started at all because
+        of the deadline.
+        See `Cleanups.run()` for details.
+
+        :Parameters:
+            cleanups : `Cleanups`
+                the `Cleanups` object that abandoned the cleanup operation
+            cleanup : `Cleanup`
+                the `Cleanup` that was abandoned
+        """
+        pass
+
+    def finished(self, cleanups):
+        """
+        Invoked after `Cleanups.run()` or `Cleanups.arun()` has finished
+        executing all of the cleanups, even if there were none.
+
+        :Parameters:
+            cleanups : `Cleanups`
+                the `Cleanups` object that executed the cleanup operations
+        """
+        pass
+
 ################################################################################
 
 class DebugCleanupListener(CleanupListener):
@@ -291,7 +1917,9 @@ class DebugCleanupListener(CleanupListener):
     An implementation of ``CleanupListener`` that prints messages to standard
     error on each event.  It may be useful to register this listener to
     understand what is going on when cleanups are executed.  The `log()` method
-    can be overridden to log the messages in a different way.
+    can be overridden to log the messages in a different way.  Since each
+    message is written synchronously, `LoggingCleanupListener` is more suitable
+    for logging the execution of large numbers of cleanups.
     """
 
     def __init__(self, f=None):
@@ -316,8 +1944,12 @@ class DebugCleanupListener(CleanupListener):
 
     def failed(self, cleanups, cleanup, exc_info):
         self.log("Cleanup operation FAILED: %s (%s)" % (cleanup, exc_info[1]))
+        import traceback
         traceback.print_exception(*exc_info)
 
+    def abandoned(self, cleanups, cleanup):
+        self.log("Cleanup operation ABANDONED: %s" % cleanup)
+
     def log(self, message):
         """
         Logs a message.  The implementation of this method in this class invokes
@@ -331,39 +1963,700 @@ class DebugCleanupListener(CleanupListener):
         """
         print(message, file=self.f)
 
+class LoggingCleanupListener(CleanupListener):
+    """
+    An implementation of ``CleanupListener`` that logs each event via the
+    ``logging`` module without slowing down the execution of cleanups.  Events
+    at a level for which the logger is not enabled are discarded at once; the
+    others are put on a queue, unformatted, and passed to the logger by a
+    background thread.  Like any logging call, the message, and the traceback
+    of a failed cleanup, are only formatted if a handler emits the record.  The
+    queue is flushed when `Cleanups.run()` finishes, via `finished()`, and by
+    `flush()`.
+    """
+
+    def __init__(self, logger=None, level=None, failed_level=None,
+            abandoned_level=None):
+        """
+        Initializes a new instance of ``LoggingCleanupListener``.
+
+        :Parameters:
+            logger : ``logging.Logger``
+                the logger to which to log the events; may be ``None`` (the
+                default) to use the logger named "cleanups"
+            level : int
+                the level at which to log cleanups starting and completing; may
+                be ``None`` (the default) to use ``logging.DEBUG``
+            failed_level : int
+                the level at which to log cleanups failing, with the traceback;
+                may be ``None`` (the default) to use ``logging.ERROR``
+            abandoned_level : int
+                the level at which to log cleanups being abandoned; may be
+                ``None`` (the default) to use ``logging.WARNING``
+        """
+        import logging
+
+        self.logger = logger if logger is not None else \
+            logging.getLogger("cleanups")
+        """The ``logging.Logger`` to which the events are logged"""
+
+        self.level = level if level is not None else logging.DEBUG
+        """The level at which cleanups starting and completing are logged"""
+
+        self.failed_level = failed_level if failed_level is not None else \
+            logging.ERROR
+        """The level at which cleanups failing are logged"""
+
+        self.abandoned_level = abandoned_level \
+            if abandoned_level is not None else logging.WARNING
+        """The level at which cleanups being abandoned are logged"""
+
+        import queue
+        self.queue = queue.SimpleQueue()
+        self.thread = None
+        self.lock = _thread.allocate_lock()
+        _track_instance(self)
+
+    def starting(self, cleanups, cleanup):
+        if self.logger.isEnabledFor(self.level):
+            self.enqueue(self.level, "Starting cleanup operation: %s",
+                (cleanup,))
+
+    def completed(self, cleanups, cleanup, retval):
+        if self.logger.isEnabledFor(self.level):
+            self.enqueue(self.level,
+                "Cleanup operation completed successfully: %s (returned %r)",
+                (cleanup, retval))
+
+    def failed(self, cleanups, cleanup, exc_info):
+        if self.logger.isEnabledFor(self.failed_level):
+            self.enqueue(self.failed_level, "Cleanup operation FAILED: %s (%s)",
+                (cleanup, exc_info[1]), exc_info)
+
+    def abandoned(self, cleanups, cleanup):
+        if self.logger.isEnabledFor(self.abandoned_level):
+            self.enqueue(self.abandoned_level,
+                "Cleanup operation ABANDONED: %s", (cleanup,))
+
+    def finished(self, cleanups):
+        self.flush()
+
+    def enqueue(self, level, msg, args, exc_info=None):
+        if self.thread is None:
+            self.start()
+        self.queue.put((level, msg, args, exc_info))
+
+    def flush(self, timeout=None):
+        """
+        Waits until every event queued so far has been passed to the logger,
+        returning ``True``, or until the timeout elapses, returning ``False``.
+
+        :Parameters:
+            timeout : float
+                the maximum number of seconds to wait; may be ``None`` (the
+                default) to wait indefinitely
+        """
+        thread = self.thread
+        if thread is None:
+            return True
+        if not thread.is_alive():
+            # the thread does not survive a fork
+            self.start()
+        import threading
+        flushed = threading.Event()
+        self.queue.put(flushed)
+        return flushed.wait(timeout)
+
+    def start(self):
+        import threading
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                thread = threading.Thread(target=self.write,
+                    name="LoggingCleanupListener", daemon=True)
+                thread.start()
+                self.thread = thread
+
+    def _after_fork_in_child(self):
+        # the events queued in the parent process are its to write, and the
+        # thread writing them does not exist in the child
+        import queue
+        self.queue = queue.SimpleQueue()
+        self.thread = None
+        self.lock = _thread.allocate_lock()
+
+    def write(self):
+        # the body of the background thread
+        import threading
+        import traceback
+        while True:
+            item = self.queue.get()
+            if isinstance(item, threading.Event):
+                item.set()
+                continue
+            (level, msg, args, exc_info) = item
+            del item
+            try:
+                self.logger.log(level, msg, *args, exc_info=exc_info)
+            except:
+                traceback.print_exc()
+            del exc_info
+
+class TimingCleanupListener(CleanupListener):
+    """
+    An implementation of ``CleanupListener`` that measures how long each cleanup
+    takes to execute, to find the cleanups that make shutdown slow.  The time
+    between `starting()` and `completed()` or `failed()` is measured with
+    ``time.perf_counter_ns()`` and aggregated by `key()` into a count, total,
+    minimum, maximum and a histogram with power-of-two buckets; the slowest
+    individual executions are also kept.  Recording a timing costs a couple of
+    dict operations and a short critical section, so this listener may be left
+    registered in production.  The results are available from `summary()` and
+    `to_json()`.
+    """
+
+    def __init__(self, slowest=10):
+        """
+        Initializes a new instance of ``TimingCleanupListener``.
+
+        :Parameters:
+            slowest : int
+                the number of slowest executions to keep
+        """
+        self.slowest = slowest
+        """The number of slowest executions to keep"""
+
+        self.starts = {}
+        self.lock = _thread.allocate_lock()
+        self.stats = {}
+        self.slowest_heap = []
+        self.seqnums = itertools.count()
+        _track_instance(self)
+
+    def starting(self, cleanups, cleanup):
+        self.starts[cleanup] = time.perf_counter_ns()
+
+    def completed(self, cleanups, cleanup, retval):
+        self.record(cleanup, False)
+
+    def failed(self, cleanups, cleanup, exc_info):
+        self.record(cleanup, True)
+
+    def abandoned(self, cleanups, cleanup):
+        self.starts.pop(cleanup, None)
+        key = self.key(cleanup)
+        with self.lock:
+            self.get_stats(key).abandoned += 1
+
+    def finished(self, cleanups):
+        # a cleanup skipped by another listener's starting() is never reported
+        # as completed or failed, so discard the start times left over from
+        # the run, which would otherwise accumulate along with the cleanups
+        starts = self.starts
+        for cleanup in list(starts):
+            if cleanup.cleanups is cleanups:
+                starts.pop(cleanup, None)
+
+    def record(self, cleanup, failed):
+        end = time.perf_counter_ns()
+        start = self.starts.pop(cleanup, None)
+        if start is None:
+            return
+        elapsed = end - start
+        key = self.key(cleanup)
+        with self.lock:
+            stats = self.stats.get(key)
+            if stats is None:
+                stats = self.get_stats(key)
+            stats.add(elapsed, failed)
+            heap = self.slowest_heap
+            if len(heap) < self.slowest:
+                import heapq
+                heapq.heappush(heap, (elapsed, next(self.seqnums), key))
+            elif heap and elapsed > heap[0][0]:
+                import heapq
+                heapq.heapreplace(heap, (elapsed, next(self.seqnums), key))
+
+    def _after_fork_in_child(self):
+        self.lock = _thread.allocate_lock()
+
+    def get_stats(self, key):
+        # ASSERTION: thread must have acquired self.lock
+        stats = self.stats.get(key)
+        if stats is None:
+            stats = self.stats[key] = _TimingStats()
+        return stats
+
+    def key(self, cleanup):
+        """
+        Returns the key by which to aggregate the timings of a cleanup: its
+        `Cleanup.name` if it is not ``None``, otherwise the qualified name of
+        its function, including the module.  Subclasses may override this
+        method to aggregate timings differently.
+
+        :Parameters:
+            cleanup : `Cleanup`
+                the cleanup whose key to return
+        """
+        if cleanup.name is not None:
+            return cleanup.name
+        func = cleanup.func
+        name = getattr(func, "__qualname__", None)
+        if name is None:
+            name = type(func).__qualname__
+        module = getattr(func, "__module__", None)
+        return name if module is None else "%s.%s" % (module, name)
+
+    def summary(self):
+        """
+        Returns a summary of the timings recorded so far as a dict of plain
+        values that can be serialized as JSON.  The dict has two items:
+        ``"cleanups"`` maps each key to a dict with the ``"count"`` of
+        executions, the number of ``"failures"`` among them, the number of
+        cleanups ``"abandoned"``, and the ``"total_ns"``, ``"mean_ns"``,
+        ``"min_ns"`` and ``"max_ns"`` durations in nanoseconds, and a
+        ``"histogram"`` list of ``[upper_bound_ns, count]`` pairs, where
+        ``count`` executions took less than ``upper_bound_ns`` but at least half
+        of it; ``"slowest"`` is a list of ``[key, ns]`` pairs for the slowest
+        executions, slowest first.
+        """
+        with self.lock:
+            cleanups = {key: stats.summary()
+                for (key, stats) in self.stats.items()}
+            slowest = [[key, elapsed] for (elapsed, seqnum, key)
+                in sorted(self.slowest_heap, reverse=True)]
+        return {"cleanups": cleanups, "slowest": slowest}
+
+    def to_json(self, **kwargs):
+        """
+        Returns `summary()` serialized as JSON.  Keyword arguments are passed
+        through to ``json.dumps()``.
+        """
+        import json
+        return json.dumps(self.summary(), **kwargs)
+
+    def reset(self):
+        """
+        Discards all timings recorded so far.
+        """
+        with self.lock:
+            self.stats.clear()
+            self.slowest_heap.clear()
+
+class _TimingStats():
+    """
+    The timings of the executions of cleanups with the same key recorded by a
+    `TimingCleanupListener`.
+    """
+
+    __slots__ = ("count", "failures", "abandoned", "total_ns", "min_ns",
+        "max_ns", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.failures = 0
+        self.abandoned = 0
+        self.total_ns = 0
+        self.min_ns = None
+        self.max_ns = None
+        # the number of executions that took n nanoseconds is counted in
+        # buckets[n.bit_length()], so bucket b counts [2**(b-1), 2**b)
+        self.buckets = [0] * 65
+
+    def add(self, elapsed, failed):
+        self.count += 1
+        if failed:
+            self.failures += 1
+        self.total_ns += elapsed
+        if self.min_ns is None or elapsed < self.min_ns:
+            self.min_ns = elapsed
+        if self.max_ns is None or elapsed > self.max_ns:
+            self.max_ns = elapsed
+        self.buckets[min(elapsed.bit_length(), 64)] += 1
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "failures": self.failures,
+            "abandoned": self.abandoned,
+            "total_ns": self.total_ns,
+            "mean_ns": self.total_ns // self.count if self.count else None,
+            "min_ns": self.min_ns,
+            "max_ns": self.max_ns,
+            "histogram": [[1 << bucket, count]
+                for (bucket, count) in enumerate(self.buckets) if count],
+        }
+
+################################################################################
+
+class FileDeletionError(OSError):
+    """
+    Raised by a cleanup registered via `Cleanups.add_unlink()` or
+    `Cleanups.add_rmtree()` if it fails to delete one or more files or
+    directory trees.
+    """
+
+    def __init__(self, errors):
+        """
+        Initializes a new instance of ``FileDeletionError``.
+
+        :Parameters:
+            errors : list
+                a list of tuples ``(path, exception)``, one for each file or
+                directory tree that could not be deleted
+        """
+        OSError.__init__(self, "failed to delete %i path(s), including %s: %s"
+            % (len(errors), errors[0][0], errors[0][1]))
+
+        self.errors = errors
+        """The list of tuples ``(path, exception)`` specified to
+        `__init__()`"""
+
 ################################################################################
 
 class _CleanupListenerNotifier():
+    """
+    Dispatches the events of a `Cleanups.run()` to the listeners.  Upon
+    creation the methods that handle each event are looked up once, skipping
+    listeners whose class does not override the method of `CleanupListener`,
+    so that dispatching an event is just a loop over the functions in the
+    corresponding ``*_funcs`` attribute, which is empty if no listener handles
+    the event.
+    """
 
-    def __init__(self, cleanups, listeners):
+    def __init__(self, cleanups, global_listeners, local_listeners):
         self.cleanups = cleanups
-        self.listeners = listeners
+        listeners = global_listeners + local_listeners
+        self.starting_funcs = self.get_funcs(listeners, "starting")
+        self.completed_funcs = self.get_funcs(listeners, "completed")
+        self.failed_funcs = self.get_funcs(listeners, "failed")
+        self.abandoned_funcs = self.get_funcs(listeners, "abandoned")
+        self.finished_funcs = self.get_funcs(listeners, "finished")
+
+    @staticmethod
+    def get_funcs(listeners, name):
+        """
+        Returns a tuple of the functions that handle the event with the given
+        name, each of which accepts the arguments of the corresponding
+        `CleanupListener` method other than ``self``.
+        """
+        funcs = []
+        default_func = getattr(CleanupListener, name)
+        for listener in listeners:
+            instance_attrs = getattr(listener, "__dict__", {})
+            if name in instance_attrs:
+                # a function assigned to the listener object itself is invoked
+                # with the listener as its first argument, like a method
+                import functools
+                funcs.append(functools.partial(instance_attrs[name], listener))
+            elif getattr(type(listener), name, default_func) is not default_func:
+                funcs.append(getattr(listener, name))
+        return tuple(funcs)
 
     def starting(self, cleanup):
-        return self.dispatch_notifications(lambda x: x.starting, cleanup)
+        return self.dispatch_notifications(self.starting_funcs, cleanup)
 
     def completed(self, cleanup, retval):
-        return self.dispatch_notifications(lambda x: x.completed, cleanup,
+        return self.dispatch_notifications(self.completed_funcs, cleanup,
             retval)
 
     def failed(self, cleanup, exc_info):
-        return self.dispatch_notifications(lambda x: x.failed, cleanup,
+        return self.dispatch_notifications(self.failed_funcs, cleanup,
             exc_info)
 
-    def dispatch_notifications(self, get_func_from_listener, *args):
+    def abandoned(self, cleanup):
+        return self.dispatch_notifications(self.abandoned_funcs, cleanup)
+
+    def finished(self):
+        return self.dispatch_notifications(self.finished_funcs)
+
+    def dispatch_notifications(self, funcs, *args):
         result = False
-        for listener in self.listeners:
+        for func in funcs:
             try:
-                func = get_func_from_listener(listener)
-                if func(listener, self.cleanups, *args):
+                if func(self.cleanups, *args):
                     result = True
             except:
+                import traceback
                 traceback.print_exc()
         return result
 
 ################################################################################
 
-cleanups = Cleanups()
-add = cleanups.add
-add_to_front = cleanups.add_to_front
-remove = cleanups.remove
+class _AtexitInstances():
+    """
+    Keeps track of the `Cleanups` objects whose cleanups are to be executed
+    when the interpreter exits.  Rather than each `Cleanups` object registering
+    its own ``atexit`` function, which would keep it alive until exit even
+    after its cleanups have run, an object is only referenced from here while
+    it has registered cleanups, and a single ``atexit`` function runs them.
+    """
+
+    SIGNAL_RETRY_INTERVAL = 0.01
+    """The number of seconds after which to deliver a signal again if it
+    interrupted the main thread while it held a lock needed to run the
+    cleanups"""
+
+    SIGNAL_RETRIES = 100
+    """The maximum number of times to deliver a signal again, as for
+    `SIGNAL_RETRY_INTERVAL`, before giving up on running the cleanups"""
+
+    LOCK_PROBE_TIMEOUT = 0.1
+    """The number of seconds to wait for each lock needed to run the cleanups
+    before concluding that it is held by the thread interrupted by a signal"""
+
+    def __init__(self):
+        self.instances = {}
+        self.lock = _thread.allocate_lock()
+        self.atexit_registered = False
+        self.previous_signal_handlers = {}
+        self.signalled = False
+        self.signal_retries = 0
+
+    def register(self, cleanups):
+        with self.lock:
+            self.instances[id(cleanups)] = cleanups
+            if not self.atexit_registered:
+                atexit.register(self.run)
+                self.atexit_registered = True
+
+    def unregister(self, cleanups):
+        with self.lock:
+            self.instances.pop(id(cleanups), None)
+
+    def run(self, max_workers=None, deadline=None):
+        """
+        Invokes `Cleanups.run()` on each registered `Cleanups` object, in the
+        reverse of the order in which they were registered, the same order in
+        which ``atexit`` would have invoked them.
+
+        :Parameters:
+            max_workers : int
+                the ``max_workers`` argument to specify to `Cleanups.run()`
+            deadline : float
+                the value of ``time.monotonic()`` by which all of the objects
+                should have finished running, or ``None`` for no deadline
+        """
+        with self.lock:
+            instances = list(self.instances.values())
+        for instance in reversed(instances):
+            if deadline is None:
+                instance.run(max_workers)
+            else:
+                instance.run(max_workers,
+                    deadline=max(deadline - time.monotonic(), 0))
+
+    def install_signal_handlers(self, signums, max_workers, deadline):
+        """
+        Installs `handle_signal()` as the handler of the given signals.  See
+        `install_signal_handlers()` for details.
+        """
+        import functools
+        import signal
+        handler = functools.partial(self.handle_signal, max_workers=max_workers,
+            deadline=deadline)
+        for signum in signums:
+            # leave ignored signals ignored
+            if signal.getsignal(signum) == signal.SIG_IGN:
+                continue
+            previous = signal.signal(signum, handler)
+            self.previous_signal_handlers.setdefault(signum, previous)
+
+    def handle_signal(self, signum, frame, max_workers, deadline):
+        import signal
+        import threading
+        if not self.signalled:
+            if not self.locks_available():
+                # the signal interrupted the main thread (on which this handler
+                # runs) while it held a lock needed to run the cleanups, so
+                # return to let it release the lock and deliver the signal
+                # again shortly, rather than deadlocking; if the lock is still
+                # held after the last retry then the cleanups are not run
+                if self.signal_retries < self.SIGNAL_RETRIES:
+                    self.signal_retries += 1
+                    timer = threading.Timer(self.SIGNAL_RETRY_INTERVAL,
+                        os.kill, (os.getpid(), signum))
+                    timer.daemon = True
+                    timer.start()
+                    return
+            else:
+                # run the cleanups on another thread that can be abandoned at
+                # the deadline, since they may block on other threads
+                if deadline is not None:
+                    deadline += time.monotonic()
+                thread = threading.Thread(target=self.run,
+                    args=(max_workers, deadline),
+                    name="cleanups signal handler", daemon=True)
+                self.signalled = True
+                thread.start()
+                thread.join(None if deadline is None else
+                    max(deadline - time.monotonic(), 0))
+            self.signalled = True
+
+        previous = self.previous_signal_handlers.get(signum)
+        if callable(previous):
+            previous(signum, frame)
+        else:
+            signal.signal(signum, signal.SIG_DFL)
+            os.kill(os.getpid(), signum)
+
+    def locks_available(self):
+        """
+        Returns whether the locks needed to run the cleanups of the registered
+        `Cleanups` objects can be acquired.  Since a signal handler blocks the
+        main thread, a lock that the interrupted main thread holds cannot be
+        acquired until the handler returns, whereas other threads only hold
+        these locks briefly.
+        """
+        timeout = self.LOCK_PROBE_TIMEOUT
+        if not self.lock.acquire(timeout=timeout):
+            return False
+        try:
+            instances = list(self.instances.values())
+        finally:
+            self.lock.release()
+        locks = [Cleanups.global_lock]
+        listeners = list(Cleanups.global_listeners)
+        for instance in instances:
+            locks.append(instance.lock)
+            if instance.journal is not None:
+                locks.append(instance.journal.lock)
+            listeners.extend(instance.listeners)
+        for listener in listeners:
+            if isinstance(listener, (LoggingCleanupListener,
+                    TimingCleanupListener)):
+                locks.append(listener.lock)
+        for lock in locks:
+            if not lock.acquire(timeout=timeout):
+                return False
+            lock.release()
+        return True
+
+_atexit_instances = _AtexitInstances()
+
+_all_instances = {}
+"""Maps the ``id()`` of every `Cleanups` object and every listener with a lock
+that exists to a weak reference to it, so that their locks can be replaced in a
+child process after a fork"""
+
+def _track_instance(instance):
+    key = id(instance)
+    def forget(ref):
+        if _all_instances.get(key) is ref:
+            del _all_instances[key]
+    _all_instances[key] = _weakref.ref(instance, forget)
+
+def _after_fork_in_child():
+    global _singleton_lock
+    _singleton_lock = _thread.allocate_lock()
+    Cleanups.global_lock = _thread.allocate_lock()
+    _atexit_instances.lock = _thread.allocate_lock()
+    _atexit_instances.signalled = False
+    _atexit_instances.signal_retries = 0
+    for ref in list(_all_instances.values()):
+        instance = ref()
+        if instance is not None:
+            instance._after_fork_in_child()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+def install_signal_handlers(signums=None, max_workers=None, deadline=None):
+    """
+    Installs handlers for signals that run the cleanups of the module-level
+    `cleanups` object and of every other `Cleanups` object created with
+    ``atexit_register=True``, which would otherwise not run if the process is
+    terminated by a signal such as ``SIGTERM`` whose default action does not
+    execute ``atexit`` functions.  Upon receiving the first of the signals the
+    cleanups are executed, exactly once, and then the signal is passed on to
+    the handler that it had before this function was invoked: a Python
+    function, such as the one that raises ``KeyboardInterrupt`` for
+    ``SIGINT``, is invoked, and otherwise the signal is re-raised with its
+    default action, which for ``SIGTERM`` terminates the process.  Subsequent
+    signals are passed on immediately, so that, for example, pressing Ctrl+C
+    a second time interrupts cleanups that are taking too long.  Signals that
+    are ignored (``SIG_IGN``) when this function is invoked remain ignored.
+    If a signal interrupts the main thread while it holds a lock needed to run
+    the cleanups, such as while it is registering a cleanup, the signal is
+    delivered again once the lock is released.  Since the main thread is
+    blocked while the cleanups run, cleanups that wait for something that the
+    main thread holds, such as a lock acquired by the interrupted code, never
+    finish unless a ``deadline`` is given.  This function must be invoked from
+    the main thread.
+
+    :Parameters:
+        signums : iterable
+            the numbers of the signals to handle; if ``None`` (the default)
+            then ``SIGTERM`` and ``SIGINT`` are handled
+        max_workers : int
+            the number of threads on which to execute each object's cleanups,
+            since the process is usually expected to exit quickly upon such a
+            signal; if ``None`` (the default) then the number of processors is
+            used
+        deadline : float
+            the number of seconds after receiving the signal within which to
+            finish executing cleanups, as for `Cleanups.run()`; the signal is
+            passed on at the deadline even if cleanups are still executing; if
+            ``None`` (the default) then there is no deadline
+    """
+    if signums is None:
+        import signal
+        signums = (signal.SIGTERM, signal.SIGINT)
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    _atexit_instances.install_signal_handlers(signums, max_workers, deadline)
+
+################################################################################
+
+_SINGLETON_NAMES = ("cleanups", "add", "add_to_front", "remove")
+
+_singleton_lock = _thread.allocate_lock()
+
+def __getattr__(name):
+    # creates the module-level Cleanups object, "cleanups", and its aliases
+    # "add", "add_to_front" and "remove" the first time that one of them is
+    # accessed, then stores them as globals so that this is not called again
+    if name not in _SINGLETON_NAMES:
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+    with _singleton_lock:
+        if "cleanups" not in globals():
+            instance = Cleanups()
+            globals().update(add=instance.add,
+                add_to_front=instance.add_to_front, remove=instance.remove)
+            # assigned last, since it marks the others as having been assigned
+            globals()["cleanups"] = instance
+    return globals()[name]
+
+def __dir__():
+    return sorted(set(globals()) | set(_SINGLETON_NAMES))
+
+################################################################################
+
+def main(args=None):
+    """
+    The entry point of ``python -m cleanups``, whose only command is
+    ``reap <journal> ...``, which invokes `reap()` on each journal file.
+    Returns the exit status: ``0`` if every journal was reaped, otherwise
+    ``1``.
+    """
+    import argparse
+    parser = argparse.ArgumentParser(prog="python -m cleanups")
+    commands = parser.add_subparsers(dest="command", required=True)
+    reap_parser = commands.add_parser("reap", help="delete the files and "
+        "directories left behind by processes killed before their cleanups")
+    reap_parser.add_argument("journals", nargs="+", metavar="journal",
+        help="the path of a journal file")
+    args = parser.parse_args(args)
+
+    status = 0
+    for journal in args.journals:
+        try:
+            count = reap(journal)
+        except (OSError, ValueError) as e:
+            print("%s: %s" % (journal, e), file=sys.stderr)
+            status = 1
+        else:
+            print("%s: reaped %i path(s)" % (journal, count))
+    return status
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -18,13 +18,24 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import asyncio
+import contextlib
+import gc
 import io
 import itertools
+import json
+import logging
+import os
+import shutil
+import signal
+import subprocess
 import sys
 import tempfile
 import threading
+import time
 import traceback
 import unittest
+import weakref
 
 
 import cleanups
@@ -32,6 +43,8 @@ from cleanups import Cleanup
 from cleanups import Cleanups
 from cleanups import CleanupListener
 from cleanups import DebugCleanupListener
+from cleanups import LoggingCleanupListener
+from cleanups import TimingCleanupListener
 
 ################################################################################
 
@@ -156,6 +169,7 @@ class TestBasicFunctionality(CleanupsTestCase):
         cleanup2 = x1.add(func2)
         listener = CleanupListenerHelper(self)
         Cleanups.add_global_listener(listener)
+        self.addCleanup(Cleanups.remove_global_listener, listener)
         x1.run()
         x2.run()
         func1.assertInvoked()
@@ -177,11 +191,1996 @@ class TestBasicFunctionality(CleanupsTestCase):
         self.assertEqual(cleanups.add_to_front, cleanups.cleanups.add_to_front)
         self.assertEqual(cleanups.remove, cleanups.cleanups.remove)
 
+    def test_module_attribute_error(self):
+        with self.assertRaises(AttributeError):
+            cleanups.Kitchener
+        self.assertIn("add", dir(cleanups))
+
+    def run_python(self, script):
+        """
+        Runs a script in a new interpreter in which the cleanups module can be
+        imported, returning its standard output.
+        """
+        process = subprocess.run([sys.executable, "-c", script],
+            cwd=os.path.dirname(os.path.abspath(cleanups.__file__)),
+            stdout=subprocess.PIPE, universal_newlines=True, timeout=60,
+            check=True)
+        return process.stdout
+
+    def test_lazy_imports(self):
+        output = self.run_python("import sys\n"
+            "before = set(sys.modules)\n"
+            "import cleanups\n"
+            "print(sorted(set(sys.modules) - before))\n")
+        imported = eval(output)
+        for name in ("asyncio", "concurrent.futures", "inspect", "logging",
+                "queue", "shutil", "signal", "threading", "traceback",
+                "weakref"):
+            self.assertNotIn(name, imported)
+
+    def test_lazy_singleton(self):
+        output = self.run_python("import cleanups\n"
+            "print('cleanups' in vars(cleanups))\n"
+            "print(cleanups._all_instances == {})\n"
+            "from cleanups import add\n"
+            "print(add == cleanups.cleanups.add)\n"
+            "print(cleanups._atexit_instances.atexit_registered)\n")
+        self.assertEqual(output.split(), ["False", "True", "True", "False"])
+
+################################################################################
+
+class TestRegistry(CleanupsTestCase):
+    """
+    Tests the bookkeeping of registered cleanups in the Cleanups class.
+    """
+
+    def test_add_to_front(self):
+        func1 = self.func("Oakville")
+        func2 = self.func("Milton")
+        func3 = self.func("Halton Hills")
+        x = Cleanups()
+        x.add(func1)
+        x.add_to_front(func2)
+        x.add(func3)
+        x.run()
+        func3.assertInvokedBefore(func1)
+        func1.assertInvokedBefore(func2)
+
+    def test_add_many(self):
+        func1 = self.func("Brampton")
+        func2 = self.func("Caledon")
+        func3 = self.func("Mississauga")
+        x = Cleanups()
+        c1 = x.add(func1)
+        handles = x.add_many([(func2, (1, 2), {}), (func3, [], {"a": 3})])
+        self.assertEqual(len(handles), 2)
+        self.assertEqual(len(x), 3)
+        for handle in handles:
+            self.assertIn(handle, x)
+        self.assertLess(c1.id, handles[0].id)
+        self.assertLess(handles[0].id, handles[1].id)
+        x.remove(handles[0])
+        x.add_many([(func2, (4,), {})])
+        x.run()
+        func2.assertInvocationCount(1)
+        func2.invocation.assertArgs(4)
+        func3.invocation.assertArgs(a=3)
+        func2.assertInvokedBefore(func3)
+        func3.assertInvokedBefore(func1)
+
+    def test_add_many_empty(self):
+        x = Cleanups()
+        self.assertEqual(x.add_many(iter(())), [])
+        self.assertEqual(len(x), 0)
+
+    def test_contains(self):
+        x = Cleanups()
+        c1 = x.add(self.func("Ajax"))
+        c2 = x.add_to_front(self.func("Pickering"))
+        self.assertIn(c1, x)
+        self.assertIn(c2, x)
+        self.assertNotIn(None, x)
+        self.assertNotIn(Cleanup(x, c1.id, c1.func, (), {}), x)
+        x.remove(c1)
+        self.assertNotIn(c1, x)
+        self.assertIn(c2, x)
+        x.run()
+        self.assertNotIn(c2, x)
+
+    def test_len(self):
+        x = Cleanups()
+        self.assertEqual(len(x), 0)
+        c1 = x.add(self.func("Whitby"))
+        x.add_to_front(self.func("Oshawa"))
+        self.assertEqual(len(x), 2)
+        x.remove(c1)
+        self.assertEqual(len(x), 1)
+        x.clear()
+        self.assertEqual(len(x), 0)
+
+    def test_remove_not_registered(self):
+        x = Cleanups()
+        c1 = x.add(self.func("Clarington"))
+        x.remove(c1)
+        with self.assertRaises(ValueError):
+            x.remove(c1)
+        with self.assertRaises(ValueError):
+            x.remove(None)
+
+    def test_remove_from_other_cleanups(self):
+        func1 = self.func("Uxbridge")
+        func2 = self.func("Scugog")
+        x1 = Cleanups()
+        x2 = Cleanups()
+        c1 = x1.add(func1)
+        c2 = x2.add(func2)
+        self.assertEqual(c1.id, c2.id)
+        with self.assertRaises(ValueError):
+            x1.remove(c2)
+        x1.run()
+        x2.run()
+        func1.assertInvoked()
+        func2.assertInvoked()
+
+    def test_run_order_after_remove(self):
+        funcs = [self.func("Brock_%i" % i) for i in range(6)]
+        x = Cleanups()
+        handles = [x.add(func) for func in funcs]
+        x.remove(handles[1])
+        x.remove(handles[4])
+        x.run()
+        funcs[1].assertNotInvoked()
+        funcs[4].assertNotInvoked()
+        funcs[5].assertInvokedBefore(funcs[3])
+        funcs[3].assertInvokedBefore(funcs[2])
+        funcs[2].assertInvokedBefore(funcs[0])
+
+################################################################################
+
+class TestAtexit(CleanupsTestCase):
+    """
+    Tests the execution of cleanups when the interpreter exits.
+    """
+
+    def setUp(self):
+        instances = cleanups._atexit_instances.instances
+        orig_instances = dict(instances)
+        def restore():
+            instances.clear()
+            instances.update(orig_instances)
+        self.addCleanup(restore)
+
+    def assertRegistered(self, x):
+        self.assertIs(cleanups._atexit_instances.instances.get(id(x)), x)
+
+    def assertNotRegistered(self, x):
+        self.assertNotIn(id(x), cleanups._atexit_instances.instances)
+
+    def test_pending(self):
+        x = Cleanups()
+        self.assertNotRegistered(x)
+        c1 = x.add(self.func("Kingston"))
+        self.assertRegistered(x)
+        x.remove(c1)
+        self.assertNotRegistered(x)
+        x.add_to_front(self.func("Belleville"))
+        self.assertRegistered(x)
+        x.run()
+        self.assertNotRegistered(x)
+        x.add_unlink("Brockville")
+        self.assertRegistered(x)
+        x.clear()
+        self.assertNotRegistered(x)
+
+    def test_context_manager(self):
+        with Cleanups() as x:
+            x.add(self.func("Gananoque"))
+            self.assertRegistered(x)
+        self.assertNotRegistered(x)
+
+    def test_atexit_register_false(self):
+        x = Cleanups(atexit_register=False)
+        x.add(self.func("Napanee"))
+        self.assertNotRegistered(x)
+        x.clear()
+
+    def test_run(self):
+        func1 = self.func("Cornwall")
+        func2 = self.func("Hawkesbury")
+        func3 = self.func("Prescott")
+        x1 = Cleanups()
+        x2 = Cleanups()
+        x3 = Cleanups(atexit_register=False)
+        x1.add(func1)
+        x2.add(func2)
+        x3.add(func3)
+        cleanups._atexit_instances.run()
+        func2.assertInvokedBefore(func1)
+        func3.assertNotInvoked()
+        self.assertNotRegistered(x1)
+        self.assertNotRegistered(x2)
+
+    def test_run_in_atexit_function(self):
+        script = ("import atexit, threading\n"
+            "import cleanups\n"
+            "x = cleanups.Cleanups(atexit_register=False)\n"
+            "def exiting():\n"
+            "    x.add(print, 'Perth')\n"
+            "    x.run()\n"
+            "    x.add(print, 'Carleton Place')\n"
+            "    print(len(x))\n"
+            "    x.run()\n"
+            "atexit.register(exiting)\n")
+        process = subprocess.run([sys.executable, "-c", script],
+            cwd=os.path.dirname(os.path.abspath(cleanups.__file__)),
+            stdout=subprocess.PIPE, universal_newlines=True, timeout=60,
+            check=True)
+        self.assertEqual(process.stdout.split("\n"),
+            ["Perth", "1", "Carleton Place", ""])
+
+    def test_garbage_collected(self):
+        x = Cleanups()
+        with x:
+            x.add(self.func("Smiths Falls"))
+        ref = weakref.ref(x)
+        del x
+        gc.collect()
+        self.assertIsNone(ref())
+
+################################################################################
+
+@unittest.skipUnless(hasattr(signal, "SIGUSR1"), "requires SIGUSR1")
+class TestSignals(CleanupsTestCase):
+    """
+    Tests executing cleanups upon a signal via install_signal_handlers().
+    """
+
+    def setUp(self):
+        atexit_instances = cleanups._atexit_instances
+        orig_instances = dict(atexit_instances.instances)
+        atexit_instances.instances.clear()
+        orig_handler = signal.getsignal(signal.SIGUSR1)
+        def restore():
+            signal.signal(signal.SIGUSR1, orig_handler)
+            atexit_instances.instances.clear()
+            atexit_instances.instances.update(orig_instances)
+            atexit_instances.previous_signal_handlers.clear()
+            atexit_instances.signalled = False
+            atexit_instances.signal_retries = 0
+        self.addCleanup(restore)
+
+        self.signals = []
+        signal.signal(signal.SIGUSR1,
+            lambda signum, frame: self.signals.append(signum))
+
+    def kill(self):
+        os.kill(os.getpid(), signal.SIGUSR1)
+
+    def test_run(self):
+        func1 = self.func("Owen Sound")
+        func2 = self.func("Meaford")
+        x1 = Cleanups()
+        x2 = Cleanups()
+        x1.add(func1)
+        x2.add(func2)
+        cleanups.install_signal_handlers([signal.SIGUSR1])
+        self.kill()
+        func2.assertInvokedBefore(func1)
+        self.assertEqual(self.signals, [signal.SIGUSR1])
+        self.assertEqual(len(x1), 0)
+        self.assertEqual(len(x2), 0)
+
+    def test_once(self):
+        func = self.func("Wiarton")
+        x = Cleanups()
+        x.add(func)
+        cleanups.install_signal_handlers([signal.SIGUSR1])
+        self.kill()
+        x.add(func)
+        self.kill()
+        func.assertInvocationCount(1)
+        self.assertEqual(self.signals, [signal.SIGUSR1] * 2)
+        x.clear()
+
+    def test_concurrent(self):
+        barrier = threading.Barrier(2, timeout=10)
+        x = Cleanups()
+        x.add(barrier.wait)
+        x.add(barrier.wait)
+        listener = CleanupListenerHelper(self)
+        x.add_listener(listener)
+        cleanups.install_signal_handlers([signal.SIGUSR1], max_workers=2)
+        self.kill()
+        listener.completed.assertInvocationCount(2)
+
+    def test_deadline(self):
+        event = threading.Event()
+        self.addCleanup(event.set)
+        x = Cleanups()
+        x.add(event.wait, 10)
+        x.add(self.func("Sauble Beach"))
+        cleanups.install_signal_handlers([signal.SIGUSR1], deadline=0.1)
+        start = time.monotonic()
+        self.kill()
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(self.signals, [signal.SIGUSR1])
+
+    def test_lock_held(self):
+        # a signal that interrupts the main thread while it holds the lock of a
+        # Cleanups object is delivered again once the lock is released, rather
+        # than deadlocking the handler
+        func = self.func("Tobermory")
+        x = Cleanups()
+        x.add(func)
+        cleanups.install_signal_handlers([signal.SIGUSR1])
+        with x.lock:
+            self.kill()
+            func.assertNotInvoked()
+        end = time.monotonic() + 10
+        while not self.signals and time.monotonic() < end:
+            time.sleep(0.01)
+        func.assertInvoked()
+        self.assertEqual(self.signals, [signal.SIGUSR1])
+
+    def test_ignored(self):
+        func = self.func("Lion's Head")
+        x = Cleanups()
+        x.add(func)
+        signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+        cleanups.install_signal_handlers([signal.SIGUSR1])
+        self.assertEqual(signal.getsignal(signal.SIGUSR1), signal.SIG_IGN)
+        self.kill()
+        func.assertNotInvoked()
+        x.clear()
+
+    def test_reinstall(self):
+        cleanups.install_signal_handlers([signal.SIGUSR1])
+        cleanups.install_signal_handlers([signal.SIGUSR1])
+        self.kill()
+        self.assertEqual(self.signals, [signal.SIGUSR1])
+
+    def test_default_action(self):
+        path = tempfile.mktemp()
+        self.addCleanup(lambda: os.path.exists(path) and os.unlink(path))
+        script = ("import os, signal, cleanups\n"
+            "cleanups.install_signal_handlers()\n"
+            "cleanups.add(open, %r, 'w')\n"
+            "os.kill(os.getpid(), signal.SIGTERM)\n"
+            "print('not terminated')\n" % path)
+        process = subprocess.run([sys.executable, "-c", script],
+            cwd=os.path.dirname(os.path.abspath(cleanups.__file__)),
+            stdout=subprocess.PIPE, timeout=60)
+        self.assertEqual(process.returncode, -signal.SIGTERM)
+        self.assertEqual(process.stdout, b"")
+        self.assertTrue(os.path.exists(path))
+
+################################################################################
+
+@unittest.skipUnless(hasattr(os, "fork"), "requires os.fork()")
+class TestFork(CleanupsTestCase):
+    """
+    Tests the behaviour of Cleanups objects in child processes after a fork.
+    """
+
+    def fork(self, func):
+        """
+        Invokes a function in a child process created by ``os.fork()``,
+        returning the list of lines that it returns, or failing if it raises an
+        exception or does not finish within 30 seconds.
+        """
+        (read_fd, write_fd) = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                os.close(read_fd)
+                with os.fdopen(write_fd, "w") as f:
+                    f.write("\n".join(func()))
+                status = 0
+            except:
+                traceback.print_exc()
+            finally:
+                os._exit(status)
+
+        os.close(write_fd)
+        deadline = time.monotonic() + 30
+        while True:
+            (result_pid, status) = os.waitpid(pid, os.WNOHANG)
+            if result_pid:
+                break
+            if time.monotonic() > deadline:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+                self.fail("child process did not finish")
+            time.sleep(0.01)
+        with os.fdopen(read_fd) as f:
+            lines = f.read().split("\n")
+        self.assertEqual(status, 0)
+        return lines
+
+    def test_inherited_not_run(self):
+        invoked = []
+        x = Cleanups()
+        x.add(invoked.append, "Ottawa")
+        x.add(invoked.append, "Nepean").inheritable = True
+        def child():
+            x.add(invoked.append, "Kanata")
+            x.run()
+            return invoked
+        self.assertEqual(self.fork(child), ["Kanata", "Nepean"])
+        x.run()
+        self.assertEqual(invoked, ["Nepean", "Ottawa"])
+
+    def test_file_deletions_not_merged(self):
+        x = Cleanups()
+        x.add_unlink(os.path.join(tempfile.gettempdir(), "Orleans"))
+        def child():
+            x.add_unlink("Gloucester")
+            return [str(len(x))]
+        self.assertEqual(self.fork(child), ["2"])
+        x.clear()
+
+    def test_lock_held(self):
+        x = Cleanups()
+        x.add(self.func("Carleton Place"))
+        acquired = threading.Event()
+        release = threading.Event()
+        def hold_locks():
+            with x.lock, Cleanups.global_lock:
+                acquired.set()
+                release.wait(10)
+        thread = threading.Thread(target=hold_locks)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(release.set)
+        acquired.wait(10)
+        def child():
+            invoked = []
+            x.add(invoked.append, "Arnprior")
+            Cleanups.add_global_listener(CleanupListener())
+            x.run()
+            return invoked
+        self.assertEqual(self.fork(child), ["Arnprior"])
+        release.set()
+        x.run()
+
+    def test_listener_locks_held(self):
+        timing = TimingCleanupListener()
+        logging_listener = LoggingCleanupListener(logging.getLogger("Renfrew"))
+        acquired = threading.Event()
+        release = threading.Event()
+        def hold_locks():
+            with timing.lock, logging_listener.lock, cleanups._singleton_lock:
+                acquired.set()
+                release.wait(10)
+        thread = threading.Thread(target=hold_locks)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(release.set)
+        acquired.wait(10)
+        def child():
+            logger = logging_listener.logger
+            logger.setLevel(logging.DEBUG)
+            logger.propagate = False
+            x = Cleanups()
+            x.add_listener(timing)
+            x.add_listener(logging_listener)
+            x.add(len, "Pembroke").name = "Pembroke"
+            x.run()
+            with cleanups._singleton_lock:
+                pass
+            return list(timing.summary()["cleanups"])
+        self.assertEqual(self.fork(child), ["Pembroke"])
+
+    def test_journal_not_inherited(self):
+        dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, dir, ignore_errors=True)
+        x = Cleanups(journal=os.path.join(dir, "parent"))
+        x.add_unlink(os.path.join(dir, "Westport"))
+        def child():
+            x.clear()
+            with self.assertRaises(ValueError):
+                Cleanups(journal=os.path.join(dir, "parent"))
+            x.open_journal(os.path.join(dir, "child"))
+            x.add_unlink(os.path.join(dir, "Portland"))
+            return [str(cleanups.reap(os.path.join(dir, "child")))]
+        self.assertEqual(self.fork(child), ["1"])
+        with self.assertRaises(ValueError):
+            x.open_journal(os.path.join(dir, "other"))
+        x.clear()
+        x.journal.close()
+
+    def test_nested_fork(self):
+        invoked = []
+        x = Cleanups()
+        x.add(invoked.append, "Perth").inheritable = True
+        x.add(invoked.append, "Almonte")
+        def child():
+            x.add(invoked.append, "Renfrew")
+            def grandchild():
+                x.add(invoked.append, "Pembroke")
+                x.run()
+                return invoked
+            lines = self.fork(grandchild)
+            x.clear()
+            return lines
+        self.assertEqual(self.fork(child), ["Pembroke", "Perth"])
+        x.clear()
+
+################################################################################
+
+class TestParallelRun(CleanupsTestCase):
+    """
+    Tests executing cleanups on multiple threads via the max_workers argument of
+    Cleanups.run().
+    """
+
+    def test_run_all(self):
+        funcs = [self.func("Markham_%i" % i) for i in range(20)]
+        x = Cleanups()
+        for func in funcs:
+            x.add(func)
+        x.run(max_workers=4)
+        for func in funcs:
+            func.assertInvocation()
+        self.assertEqual(len(x), 0)
+
+    def test_concurrent(self):
+        barrier = threading.Barrier(3, timeout=10)
+        x = Cleanups()
+        for i in range(3):
+            x.add(barrier.wait)
+        listener = CleanupListenerHelper(self)
+        x.add_listener(listener)
+        x.run(max_workers=3)
+        listener.completed.assertInvocationCount(3)
+        listener.failed.assertNotInvoked()
+
+    def test_max_workers_attribute(self):
+        barrier = threading.Barrier(2, timeout=10)
+        with Cleanups(max_workers=2) as x:
+            x.add(barrier.wait)
+            x.add(barrier.wait)
+            listener = CleanupListenerHelper(self)
+            x.add_listener(listener)
+        listener.completed.assertInvocationCount(2)
+        listener.failed.assertNotInvoked()
+
+    def test_listener(self):
+        func1 = self.func("Richmond Hill")
+        func2 = self.func("Aurora", exception=KeyError("Aurora"))
+        x = Cleanups()
+        cleanup1 = x.add(func1)
+        cleanup2 = x.add(func2)
+        listener = CleanupListenerHelper(self)
+        x.add_listener(listener)
+        x.run(max_workers=2)
+        listener.starting.assertInvocationCount(2)
+        listener.completed.assertInvocation(listener, x, cleanup1, None)
+        listener.failed.assertInvocationCount(1)
+        args = listener.failed.invocation.args
+        self.assertIs(args[2], cleanup2)
+        self.assertIs(args[3][1], func2.exception)
+
+    def test_starting_skips(self):
+        func = self.func("Newmarket")
+        x = Cleanups()
+        x.add(func)
+        listener = CleanupListenerHelper(self)
+        listener.starting.retval = True
+        x.add_listener(listener)
+        x.run(max_workers=2)
+        func.assertNotInvoked()
+        listener.starting.assertInvocationCount(1)
+        listener.completed.assertNotInvoked()
+        listener.failed.assertNotInvoked()
+
+    def test_invalid_max_workers(self):
+        func = self.func("King City")
+        x = Cleanups()
+        x.add(func)
+        with self.assertRaises(ValueError):
+            x.run(max_workers=0)
+        func.assertNotInvoked()
+        self.assertEqual(len(x), 1)
+
+################################################################################
+
+class TestThreads(CleanupsTestCase):
+    """
+    Tests registering and removing cleanups from multiple threads.
+    """
+
+    def in_thread(self, func, *args):
+        """
+        Invokes a function on a new thread, waits for it to complete, and
+        returns what it returned or raises what it raised.
+        """
+        result = {}
+        def target():
+            try:
+                result["retval"] = func(*args)
+            except Exception as e:
+                result["exception"] = e
+        thread = threading.Thread(target=target)
+        thread.start()
+        thread.join()
+        if "exception" in result:
+            raise result["exception"]
+        return result["retval"]
+
+    def test_order(self):
+        funcs = [self.func("Peterborough_%i" % i) for i in range(6)]
+        x = Cleanups()
+        x.add(funcs[0])
+        self.in_thread(x.add, funcs[1])
+        x.add_to_front(funcs[2])
+        self.in_thread(x.add_to_front, funcs[3])
+        self.in_thread(x.add, funcs[4])
+        x.add(funcs[5])
+        self.assertEqual(len(x), 6)
+        x.run()
+        funcs[5].assertInvokedBefore(funcs[4])
+        funcs[4].assertInvokedBefore(funcs[1])
+        funcs[1].assertInvokedBefore(funcs[0])
+        funcs[0].assertInvokedBefore(funcs[2])
+        funcs[2].assertInvokedBefore(funcs[3])
+
+    def test_remove_other_thread(self):
+        func1 = self.func("Lindsay")
+        func2 = self.func("Cobourg")
+        x = Cleanups()
+        c1 = self.in_thread(x.add, func1)
+        x.add(func2)
+        self.assertIn(c1, x)
+        x.remove(c1)
+        self.assertNotIn(c1, x)
+        with self.assertRaises(ValueError):
+            self.in_thread(x.remove, c1)
+        x.run()
+        func1.assertNotInvoked()
+        func2.assertInvocation()
+
+    def test_concurrent(self):
+        num_threads = 8
+        n = 200
+        barrier = threading.Barrier(num_threads)
+        x = Cleanups()
+        kept = []
+        def worker():
+            barrier.wait()
+            for i in range(n):
+                cleanup = x.add(kept.append, None)
+                if i % 2 == 0:
+                    x.remove(cleanup)
+        threads = [threading.Thread(target=worker) for i in range(num_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(x), num_threads * n // 2)
+        x.run()
+        self.assertEqual(len(kept), num_threads * n // 2)
+
+    def test_file_deletions_order(self):
+        # a file registered after another thread registered a cleanup is not
+        # added to the cleanup that deletes the files registered before it
+        dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, dir)
+        paths = [os.path.join(dir, name) for name in ("Brighton", "Trenton")]
+        for path in paths:
+            open(path, "w").close()
+        existed = []
+        def check():
+            existed.extend(os.path.exists(path) for path in paths)
+        x = Cleanups()
+        x.add_unlink(paths[0])
+        self.in_thread(x.add, check)
+        x.add_unlink(paths[1])
+        self.assertEqual(len(x), 3)
+        x.run()
+        self.assertEqual(existed, [True, False])
+
+################################################################################
+
+class TestProcesses(CleanupsTestCase):
+    """
+    Tests executing cleanups in other processes via the max_processes argument
+    of Cleanups.run().
+    """
+
+    def test_run_in_process(self):
+        x = Cleanups()
+        c1 = x.add(os.getpid)
+        c1.run_in_process = True
+        c2 = x.add(os.getpid)
+        c3 = x.add(int, "x")
+        c3.run_in_process = True
+        listener = RecordingCleanupListener()
+        x.add_listener(listener)
+        x.run(max_processes=2)
+
+        events = {event[2]: event for event in listener.events
+            if event[0] != "starting"}
+        self.assertEqual(events[c1][0], "completed")
+        self.assertNotEqual(events[c1][3], os.getpid())
+        self.assertEqual(events[c2][0], "completed")
+        self.assertEqual(events[c2][3], os.getpid())
+        self.assertEqual(events[c3][0], "failed")
+        self.assertIsInstance(events[c3][3][1], ValueError)
+
+    def test_without_max_processes(self):
+        x = Cleanups()
+        c1 = x.add(os.getpid)
+        c1.run_in_process = True
+        listener = RecordingCleanupListener()
+        x.add_listener(listener)
+        x.run()
+        self.assertEqual(listener.events[1], ("completed", x, c1, os.getpid()))
+
+    def test_invalid_max_processes(self):
+        func = self.func("Trenton")
+        x = Cleanups()
+        x.add(func)
+        with self.assertRaises(ValueError):
+            x.run(max_processes=0)
+        func.assertNotInvoked()
+        x.clear()
+
+################################################################################
+
+class TestTimeouts(CleanupsTestCase):
+    """
+    Tests abandoning cleanups that exceed their timeout or the deadline given
+    to Cleanups.run().
+    """
+
+    def hang(self):
+        """
+        Returns a function that blocks until the test completes.
+        """
+        event = threading.Event()
+        self.addCleanup(event.set)
+        return event.wait
+
+    def events(self, listener, cleanup):
+        return [event[0] for event in listener.events if event[2] is cleanup]
+
+    def test_timeout(self):
+        func1 = self.func("Owen Sound", retval=7)
+        func2 = self.func("Meaford", exception=KeyError("Meaford"))
+        x = Cleanups()
+        c1 = x.add(func1)
+        c2 = x.add(func2)
+        c3 = x.add(self.hang())
+        for cleanup in (c1, c2, c3):
+            cleanup.timeout = 0.05
+        listener = RecordingCleanupListener()
+        x.add_listener(listener)
+        x.run()
+        self.assertEqual(self.events(listener, c3), ["starting", "abandoned"])
+        self.assertEqual(self.events(listener, c2), ["starting", "failed"])
+        self.assertEqual(self.events(listener, c1), ["starting", "completed"])
+        self.assertEqual(listener.events[-1][3], 7)
+
+    def test_deadline(self):
+        func = self.func("Wiarton")
+        x = Cleanups()
+        c1 = x.add(func)
+        c2 = x.add(self.hang())
+        listener = RecordingCleanupListener()
+        x.add_listener(listener)
+        start = time.monotonic()
+        x.run(deadline=0.05)
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(self.events(listener, c2), ["starting", "abandoned"])
+        self.assertEqual(self.events(listener, c1), ["abandoned"])
+        func.assertNotInvoked()
+
+    def test_best_effort(self):
+        func1 = self.func("Hanover")
+        func2 = self.func("Walkerton")
+        func3 = self.func("Kincardine")
+        x = Cleanups()
+        c1 = x.add(func1)
+        c1.timeout = 30
+        c2 = x.add(func2)
+        c3 = x.add(func3)
+        c3.best_effort = True
+        listener = RecordingCleanupListener()
+        x.add_listener(listener)
+        x.run(deadline=10)
+        func1.assertInvocation()
+        func2.assertInvocation()
+        func3.assertNotInvoked()
+        self.assertEqual(self.events(listener, c3), ["abandoned"])
+
+    def test_best_effort_enough_time(self):
+        func1 = self.func("Port Elgin")
+        func2 = self.func("Southampton")
+        x = Cleanups()
+        c1 = x.add(func1)
+        c1.timeout = 5
+        c2 = x.add(func2)
+        c2.best_effort = True
+        x.run(deadline=30)
+        func2.assertInvokedBefore(func1)
+
+    def test_threads(self):
+        funcs = [self.func("Goderich_%i" % i) for i in range(4)]
+        x = Cleanups()
+        for func in funcs:
+            x.add(func).timeout = 5
+        hung = x.add(self.hang())
+        hung.timeout = 0.05
+        listener = RecordingCleanupListener()
+        x.add_listener(listener)
+        x.run(max_workers=2)
+        for func in funcs:
+            func.assertInvocation()
+        self.assertEqual(self.events(listener, hung), ["starting", "abandoned"])
+
+    def test_threads_stopped(self):
+        count = threading.active_count()
+        for i in range(20):
+            x = Cleanups()
+            x.add(self.func("Clinton_%i" % i)).timeout = 5
+            x.add(self.func("Seaforth_%i" % i))
+            x.run(deadline=10)
+        self.assertEqual(threading.active_count(), count)
+
+################################################################################
+
+class TestDependencies(CleanupsTestCase):
+    """
+    Tests the ordering of cleanups declared with Cleanups.add_dependency().
+    """
+
+    def test_order(self):
+        func1 = self.func("Barrie")
+        func2 = self.func("Orillia")
+        func3 = self.func("Midland")
+        x = Cleanups()
+        c1 = x.add(func1)
+        c2 = x.add(func2)
+        c3 = x.add(func3)
+        x.add_dependency(c2, c1)
+        x.run()
+        func3.assertInvokedBefore(func1)
+        func1.assertInvokedBefore(func2)
+
+    def test_multiple_prerequisites(self):
+        funcs = [self.func("Innisfil_%i" % i) for i in range(5)]
+        x = Cleanups()
+        handles = [x.add(func) for func in funcs]
+        x.add_dependency(handles[4], handles[0], handles[2])
+        x.add_dependency(handles[2], handles[1])
+        x.run()
+        funcs[3].assertInvokedBefore(funcs[1])
+        funcs[1].assertInvokedBefore(funcs[2])
+        funcs[2].assertInvokedBefore(funcs[0])
+        funcs[0].assertInvokedBefore(funcs[4])
+
+    def test_failed_prerequisite(self):
+        func1 = self.func("Bradford", exception=KeyError("Bradford"))
+        func2 = self.func("Collingwood")
+        x = Cleanups()
+        c1 = x.add(func1)
+        c2 = x.add(func2)
+        x.add_dependency(c2, c1)
+        x.run()
+        func1.assertInvokedBefore(func2)
+
+    def test_removed_prerequisite(self):
+        func1 = self.func("Wasaga Beach")
+        func2 = self.func("Penetanguishene")
+        x = Cleanups()
+        c1 = x.add(func1)
+        c2 = x.add(func2)
+        x.add_dependency(c2, c1)
+        x.remove(c1)
+        x.run()
+        func1.assertNotInvoked()
+        func2.assertInvocation()
+
+    def test_cycle(self):
+        x = Cleanups()
+        c1 = x.add(self.func("Gravenhurst"))
+        c2 = x.add(self.func("Bracebridge"))
+        c3 = x.add(self.func("Huntsville"))
+        x.add_dependency(c2, c1)
+        x.add_dependency(c3, c2)
+        with self.assertRaises(ValueError):
+            x.add_dependency(c1, c3)
+        with self.assertRaises(ValueError):
+            x.add_dependency(c1, c1)
+        x.clear()
+
+    def test_not_registered(self):
+        x1 = Cleanups()
+        x2 = Cleanups()
+        c1 = x1.add(self.func("Parry Sound"))
+        c2 = x2.add(self.func("Sundridge"))
+        with self.assertRaises(ValueError):
+            x1.add_dependency(c1, c2)
+        with self.assertRaises(ValueError):
+            x1.add_dependency(c2, c1)
+        x1.clear()
+        x2.clear()
+
+    def test_threads(self):
+        funcs = [self.func("Orangeville_%i" % i) for i in range(8)]
+        x = Cleanups()
+        handles = [x.add(func) for func in funcs]
+        for i in range(1, 8):
+            x.add_dependency(handles[i - 1], handles[i])
+        x.run(max_workers=4)
+        for i in range(1, 8):
+            funcs[i].assertInvokedBefore(funcs[i - 1])
+
+    def test_threads_concurrent(self):
+        barrier = threading.Barrier(2, timeout=10)
+        func = self.func("Shelburne")
+        x = Cleanups()
+        c1 = x.add(barrier.wait)
+        c2 = x.add(barrier.wait)
+        c3 = x.add(func)
+        x.add_dependency(c1, c3)
+        x.add_dependency(c2, c3)
+        listener = CleanupListenerHelper(self)
+        x.add_listener(listener)
+        x.run(max_workers=2)
+        func.assertInvocation()
+        listener.completed.assertInvocationCount(3)
+        listener.failed.assertNotInvoked()
+
+################################################################################
+
+class TestPriorities(CleanupsTestCase):
+    """
+    Tests the ordering of cleanups by Cleanup.priority and named phases.
+    """
+
+    def test_order(self):
+        func1 = self.func("Kingston")
+        func2 = self.func("Belleville")
+        func3 = self.func("Napanee")
+        func4 = self.func("Brockville")
+        x = Cleanups()
+        x.add(func1).priority = 1
+        x.add(func2)
+        x.add_to_front(func3).priority = 2
+        x.add(func4).priority = 1
+        x.run()
+        func3.assertInvokedBefore(func4)
+        func4.assertInvokedBefore(func1)
+        func1.assertInvokedBefore(func2)
+
+    def test_negative_priority(self):
+        func1 = self.func("Trenton")
+        func2 = self.func("Picton")
+        x = Cleanups()
+        x.add(func1).priority = -1
+        x.add(func2)
+        x.run()
+        func2.assertInvokedBefore(func1)
+
+    def test_barrier(self):
+        finished = []
+        def flush(name):
+            time.sleep(0.05)
+            finished.append(name)
+        x = Cleanups()
+        x.add(lambda: finished.append(len(finished)))
+        x.add(flush, "Gananoque").priority = 1
+        x.add(flush, "Prescott").priority = 1
+        x.run(max_workers=3)
+        self.assertEqual(sorted(finished[:2]), ["Gananoque", "Prescott"])
+        self.assertEqual(finished[2], 2)
+
+    def test_phases(self):
+        func1 = self.func("Cobourg")
+        func2 = self.func("Port Hope")
+        func3 = self.func("Bowmanville")
+        x = Cleanups()
+        x.define_phase("flush", 2)
+        x.define_phase("close", 1)
+        x.define_phase("delete", 0)
+        c1 = x.add_to_phase("delete", func1)
+        c2 = x.add_to_phase("flush", func2)
+        c3 = x.add_to_phase("close", func3)
+        self.assertEqual((c1.priority, c2.priority, c3.priority), (0, 2, 1))
+        x.run()
+        func2.assertInvokedBefore(func3)
+        func3.assertInvokedBefore(func1)
+
+    def test_add_to_phase_args(self):
+        func = self.func("Whitby")
+        x = Cleanups()
+        x.define_phase("close", 1)
+        x.add_to_phase("close", func, 1, key=2)
+        x.run()
+        func.assertInvocation(1, key=2)
+
+    def test_undefined_phase(self):
+        func = self.func("Oshawa")
+        x = Cleanups()
+        with self.assertRaises(ValueError):
+            x.add_to_phase("flush", func)
+        self.assertEqual(len(x), 0)
+
+    def test_dependency_on_later_phase(self):
+        func1 = self.func("Ajax")
+        func2 = self.func("Pickering")
+        x = Cleanups()
+        c1 = x.add(func1)
+        c2 = x.add(func2)
+        c2.priority = 1
+        x.add_dependency(c2, c1)
+        x.run()
+        func2.assertInvokedBefore(func1)
+
+    def test_arun(self):
+        func1 = self.func("Lindsay")
+        func2 = self.func("Peterborough")
+        func3 = self.func("Fenelon Falls")
+        x = Cleanups()
+        x.add(func1).priority = 1
+        x.add(func2)
+        x.add(func3).priority = 1
+        asyncio.run(x.arun(max_concurrency=2))
+        func3.assertInvokedBefore(func1)
+        func1.assertInvokedBefore(func2)
+
+################################################################################
+
+class TestTags(CleanupsTestCase):
+    """
+    Tests tagging cleanups and running, removing and counting them by tag.
+    """
+
+    def test_run_tag(self):
+        func1 = self.func("Sudbury")
+        func2 = self.func("Espanola")
+        func3 = self.func("Capreol")
+        func4 = self.func("Chelmsford")
+        x = Cleanups()
+        c1 = x.add_tagged("job1", func1)
+        x.add(func2)
+        x.tag(x.add_to_front(func3), "job1")
+        x.add_tagged("job1", func4, 1, a=2)
+        self.assertEqual(x.len_tagged("job1"), 3)
+        self.assertEqual(c1.tags, ("job1",))
+        x.run(tag="job1")
+        func4.assertInvokedBefore(func1)
+        func1.assertInvokedBefore(func3)
+        func4.invocation.assertArgs(1, a=2)
+        func2.assertNotInvoked()
+        self.assertEqual(len(x), 1)
+        self.assertEqual(x.len_tagged("job1"), 0)
+        x.run(tag="job1")
+        x.run()
+        func2.assertInvoked()
+        func1.assertInvocationCount(1)
+
+    def test_run_tag_dependencies(self):
+        func1 = self.func("Timmins")
+        func2 = self.func("Cochrane")
+        func3 = self.func("Kapuskasing")
+        x = Cleanups()
+        c1 = x.add_tagged("north", func1)
+        c2 = x.add_tagged("north", func2)
+        c3 = x.add(func3)
+        x.add_dependency(c2, c1)
+        x.add_dependency(c3, c2)
+        x.run(tag="north")
+        func1.assertInvokedBefore(func2)
+        x.run()
+        func3.assertInvoked()
+
+    def test_multiple_tags(self):
+        func1 = self.func("Hearst")
+        func2 = self.func("Moosonee")
+        x = Cleanups()
+        c1 = x.add_tagged("a", func1)
+        c2 = x.add_tagged("b", func2)
+        x.tag(c1, "b", "c", "b")
+        self.assertEqual(c1.tags, ("a", "b", "c"))
+        self.assertEqual(x.len_tagged("b"), 2)
+        self.assertEqual(x.remove_tagged("b"), 2)
+        self.assertEqual(x.remove_tagged("b"), 0)
+        self.assertEqual(len(x), 0)
+        self.assertEqual(x.len_tagged("a"), 0)
+        self.assertEqual(x.tags, {})
+        x.run()
+        func1.assertNotInvoked()
+        func2.assertNotInvoked()
+
+    def test_remove_unindexes(self):
+        x = Cleanups()
+        c1 = x.add_tagged("a", self.func("Wawa"))
+        c2 = x.add_tagged("a", self.func("Marathon"))
+        x.remove(c1)
+        self.assertEqual(x.len_tagged("a"), 1)
+        x.run()
+        self.assertEqual(x.len_tagged("a"), 0)
+        x.add_tagged("a", self.func("Nipigon"))
+        x.clear()
+        self.assertEqual(x.len_tagged("a"), 0)
+
+    def test_tag_concurrent_remove(self):
+        x = Cleanups()
+        handles = [x.add(self.func("Kenora")) for i in range(2000)]
+        def tag():
+            for handle in handles:
+                try:
+                    x.tag(handle, "a")
+                except ValueError:
+                    pass
+        thread = threading.Thread(target=tag)
+        thread.start()
+        for handle in handles:
+            x.remove(handle)
+        thread.join()
+        self.assertEqual(x.len_tagged("a"), 0)
+
+    def test_tag_not_registered(self):
+        x = Cleanups()
+        c1 = x.add(self.func("Dryden"))
+        x.remove(c1)
+        with self.assertRaises(ValueError):
+            x.tag(c1, "a")
+        self.assertEqual(x.len_tagged("a"), 0)
+
+################################################################################
+
+class TestSavepoints(CleanupsTestCase):
+    """
+    Tests Cleanups.savepoint(), Cleanups.run_since() and
+    Cleanups.discard_since().
+    """
+
+    def test_run_since(self):
+        func1 = self.func("Sarnia")
+        func2 = self.func("Petrolia")
+        func3 = self.func("Forest")
+        func4 = self.func("Wyoming")
+        func5 = self.func("Strathroy")
+        x = Cleanups()
+        x.add(func1)
+        x.add_to_front(func2)
+        mark = x.savepoint()
+        x.add(func3)
+        x.add_to_front(func4)
+        x.add(func5)
+        x.run_since(mark)
+        func5.assertInvokedBefore(func3)
+        func3.assertInvokedBefore(func4)
+        func1.assertNotInvoked()
+        func2.assertNotInvoked()
+        self.assertEqual(len(x), 2)
+        x.run()
+        func1.assertInvokedBefore(func2)
+        func5.assertInvocationCount(1)
+
+    def test_discard_since(self):
+        func1 = self.func("Goderich")
+        func2 = self.func("Clinton")
+        x = Cleanups()
+        x.add(func1)
+        mark = x.savepoint()
+        self.assertEqual(x.discard_since(mark), 0)
+        x.tag(x.add(func2), "a")
+        x.add_unlink(os.path.join(tempfile.gettempdir(), "Seaforth"))
+        self.assertEqual(x.discard_since(mark), 2)
+        self.assertEqual(len(x), 1)
+        self.assertEqual(x.len_tagged("a"), 0)
+        x.run()
+        func1.assertInvoked()
+        func2.assertNotInvoked()
+
+    def test_file_deletions(self):
+        dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, dir, ignore_errors=True)
+        paths = [os.path.join(dir, name)
+            for name in ("Zurich", "Grand Bend", "Bayfield", "Hensall")]
+        for path in paths:
+            with open(path, "wb"):
+                pass
+        x = Cleanups()
+        x.add_unlink(paths[0])
+        mark = x.savepoint()
+        x.add_unlink(paths[1])
+        self.assertEqual(x.discard_since(mark), 1)
+        mark = x.savepoint()
+        x.add_unlink(paths[2])
+        x.add_unlink(paths[3])
+        x.run_since(mark)
+        self.assertTrue(os.path.exists(paths[0]))
+        self.assertTrue(os.path.exists(paths[1]))
+        self.assertFalse(os.path.exists(paths[2]))
+        self.assertFalse(os.path.exists(paths[3]))
+        self.assertEqual(len(x), 1)
+        x.run()
+        self.assertFalse(os.path.exists(paths[0]))
+
+    def test_nested(self):
+        funcs = [self.func("Exeter_%i" % i) for i in range(4)]
+        x = Cleanups()
+        x.add(funcs[0])
+        mark1 = x.savepoint()
+        x.add(funcs[1])
+        mark2 = x.savepoint()
+        x.add(funcs[2])
+        x.discard_since(mark2)
+        x.add(funcs[3])
+        x.run_since(mark1)
+        funcs[3].assertInvokedBefore(funcs[1])
+        funcs[0].assertNotInvoked()
+        funcs[2].assertNotInvoked()
+
+    def test_threads(self):
+        func1 = self.func("Mitchell")
+        func2 = self.func("St. Marys")
+        func3 = self.func("Listowel")
+        x = Cleanups()
+        x.add(func1)
+        mark = x.savepoint()
+        thread = threading.Thread(target=x.add, args=(func2,))
+        thread.start()
+        thread.join()
+        x.add(func3)
+        x.run_since(mark)
+        func3.assertInvokedBefore(func2)
+        func1.assertNotInvoked()
+
+    def test_dependencies(self):
+        func1 = self.func("Stratford")
+        func2 = self.func("Shakespeare")
+        x = Cleanups()
+        mark = x.savepoint()
+        c1 = x.add(func1)
+        c2 = x.add(func2)
+        x.add_dependency(c2, c1)
+        x.run_since(mark)
+        func1.assertInvokedBefore(func2)
+        self.assertEqual(x.dependencies, {})
+
+################################################################################
+
+class TestKeys(CleanupsTestCase):
+    """
+    Tests keyed registration with Cleanups.add_keyed(), the key parameters of
+    Cleanups.add_unlink() and Cleanups.add_rmtree(), and Cleanups.remove_key().
+    """
+
+    def test_add_keyed(self):
+        func1 = self.func("Barrie")
+        func2 = self.func("Orillia")
+        x = Cleanups()
+        c1 = x.add_keyed("k", func1, 1)
+        c2 = x.add_keyed("k", func2, 2)
+        self.assertIs(c1, c2)
+        self.assertEqual(c1.key, "k")
+        self.assertEqual(len(x), 1)
+        x.run()
+        func1.invocation.assertArgs(1)
+        func2.assertNotInvoked()
+        c3 = x.add_keyed("k", func2)
+        self.assertIsNot(c3, c1)
+        x.run()
+        func2.assertInvoked()
+
+    def test_key_none(self):
+        x = Cleanups()
+        with self.assertRaises(ValueError):
+            x.add_keyed(None, self.func("Elliot Lake"))
+        self.assertEqual(len(x), 0)
+        self.assertEqual(x.keys, {})
+
+    def test_remove_key(self):
+        func1 = self.func("Midland")
+        func2 = self.func("Collingwood")
+        x = Cleanups()
+        c1 = x.add_keyed("k", func1)
+        self.assertTrue(x.remove_key("k"))
+        self.assertFalse(x.remove_key("k"))
+        self.assertNotIn(c1, x)
+        x.add_keyed("k", func2)
+        x.run()
+        func1.assertNotInvoked()
+        func2.assertInvoked()
+
+    def test_remove_unindexes(self):
+        x = Cleanups()
+        c1 = x.add_keyed("a", self.func("Wasaga Beach"))
+        x.remove(c1)
+        self.assertEqual(x.keys, {})
+        x.tag(x.add_keyed("b", self.func("Penetanguishene")), "t")
+        x.remove_tagged("t")
+        mark = x.savepoint()
+        x.add_keyed("c", self.func("Innisfil"))
+        x.discard_since(mark)
+        x.add_keyed("d", self.func("Bradford"))
+        x.clear()
+        self.assertEqual(x.keys, {})
+        self.assertEqual(len(x), 0)
+
+    def test_unlink_key(self):
+        dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, dir, ignore_errors=True)
+        path1 = os.path.join(dir, "Gravenhurst")
+        path2 = os.path.join(dir, "Bracebridge")
+        path3 = os.path.join(dir, "Huntsville")
+        for path in (path1, path2, path3):
+            with open(path, "wb"):
+                pass
+        x = Cleanups(journal=os.path.join(dir, "journal"))
+        x.add_unlink(path1, key=path1)
+        x.add_unlink(path2)
+        x.add_unlink(path1, key=path1)
+        x.add_rmtree(path3, key=path3)
+        self.assertTrue(x.remove_key(path3))
+        self.assertEqual(len(x), 2)
+        listener = CleanupListenerHelper(self)
+        x.add_listener(listener)
+        x.run()
+        listener.failed.assertNotInvoked()
+        self.assertFalse(os.path.exists(path1))
+        self.assertFalse(os.path.exists(path2))
+        self.assertTrue(os.path.exists(path3))
+        x.journal.close()
+
+    def test_unlink_key_not_merged(self):
+        x = Cleanups()
+        x.add_unlink("Almonte")
+        x.add_unlink("Carleton Place", key="k")
+        x.add_unlink("Arnprior")
+        self.assertEqual(len(x), 3)
+        self.assertTrue(x.remove_key("k"))
+        x.clear()
+
+################################################################################
+
+class TestChildScopes(CleanupsTestCase):
+    """
+    Tests child scopes created by Cleanups.child().
+    """
+
+    def test_parent_runs_child(self):
+        func1 = self.func("Sudbury")
+        func2 = self.func("Espanola")
+        func3 = self.func("Capreol")
+        x = Cleanups()
+        x.add(func1)
+        child = x.child()
+        child.add(func2)
+        x.add(func3)
+        self.assertIs(child.parent, x)
+        self.assertIn(child.parent_cleanup, x)
+        x.run()
+        func3.assertInvokedBefore(func2)
+        func2.assertInvokedBefore(func1)
+        self.assertEqual(len(child), 0)
+        self.assertIsNone(child.parent_cleanup)
+
+    def test_child_run_detaches(self):
+        func1 = self.func("Timmins")
+        func2 = self.func("Cochrane")
+        x = Cleanups()
+        x.add(func1)
+        child = x.child()
+        child.add(func2)
+        child.run()
+        func2.assertInvocation()
+        func1.assertNotInvoked()
+        self.assertEqual(len(x), 1)
+        x.run()
+        func1.assertInvocation()
+        func2.assertInvocationCount(1)
+
+    def test_context_manager(self):
+        func = self.func("Kapuskasing")
+        x = Cleanups()
+        with x.child() as child:
+            child.add(func)
+        func.assertInvocation()
+        self.assertEqual(len(x), 0)
+
+    def test_nested(self):
+        func1 = self.func("Hearst")
+        func2 = self.func("Smooth Rock Falls")
+        x = Cleanups()
+        child = x.child()
+        grandchild = child.child()
+        child.add(func1)
+        grandchild.add(func2)
+        x.run()
+        func1.assertInvokedBefore(func2)
+
+    def test_concurrent(self):
+        barrier = threading.Barrier(2, timeout=10)
+        x = Cleanups()
+        x.child().add(barrier.wait)
+        x.child().add(barrier.wait)
+        listener = CleanupListenerHelper(self)
+        x.add_listener(listener)
+        x.run(max_workers=2)
+        # the children were created before the listener was added
+        listener.completed.assertInvocationCount(2)
+        listener.failed.assertNotInvoked()
+
+    def test_listeners_inherited(self):
+        x = Cleanups()
+        listener = RecordingCleanupListener()
+        x.add_listener(listener)
+        child = x.child()
+        cleanup = child.add(self.func("Moosonee"))
+        child.run()
+        self.assertEqual([event[:3] for event in listener.events],
+            [("starting", child, cleanup), ("completed", child, cleanup)])
+
+    def test_arun_detaches(self):
+        func = self.func("Iroquois Falls")
+        x = Cleanups()
+        child = x.child()
+        child.add(func)
+        asyncio.run(child.arun())
+        func.assertInvocation()
+        self.assertEqual(len(x), 0)
+
+################################################################################
+
+class TestAsync(CleanupsTestCase):
+    """
+    Tests executing cleanups from a coroutine via Cleanups.arun().
+    """
+
+    def coroutine_func(self, name, retval=None, exception=None):
+        """
+        Creates and returns a coroutine function that invokes a new
+        `FunctionSimulator` after yielding to the event loop, along with that
+        ``FunctionSimulator``.
+        """
+        func = self.func(name, retval=retval, exception=exception)
+        async def coroutine_func(*args, **kwargs):
+            await asyncio.sleep(0)
+            return func(*args, **kwargs)
+        return (coroutine_func, func)
+
+    def test_arun(self):
+        (coroutine_func, func1) = self.coroutine_func("Sudbury", retval=5)
+        func2 = self.func("Espanola")
+        x = Cleanups()
+        cleanup1 = x.add(coroutine_func, 1, a=2)
+        x.add(func2)
+        listener = CleanupListenerHelper(self)
+        x.add_listener(listener)
+        asyncio.run(x.arun())
+        func1.assertInvocation(1, a=2)
+        func2.assertInvokedBefore(func1)
+        listener.completed.invocations[1].assertArgs(listener, x, cleanup1, 5)
+        self.assertEqual(len(x), 0)
+
+    def test_failed(self):
+        exception = KeyError("Timmins")
+        (coroutine_func, func) = self.coroutine_func("Timmins",
+            exception=exception)
+        x = Cleanups()
+        cleanup = x.add(coroutine_func)
+        listener = CleanupListenerHelper(self)
+        x.add_listener(listener)
+        asyncio.run(x.arun())
+        listener.completed.assertNotInvoked()
+        listener.failed.assertInvocationCount(1)
+        args = listener.failed.invocation.args
+        self.assertIs(args[2], cleanup)
+        self.assertIs(args[3][1], exception)
+
+    def test_cancelled(self):
+        for max_concurrency in (None, 2):
+            funcs = [self.func("Mattawa_%i" % i) for i in range(4)]
+            async def main():
+                blocked = asyncio.Event()
+                x = Cleanups()
+                for func in funcs:
+                    x.add(func)
+                x.add(blocked.wait)
+                x.add(blocked.wait)
+                listener = RecordingCleanupListener()
+                x.add_listener(listener)
+                task = asyncio.ensure_future(x.arun(max_concurrency))
+                while len(listener.events) < (max_concurrency or 1):
+                    await asyncio.sleep(0)
+                task.cancel()
+                with self.assertRaises(asyncio.CancelledError):
+                    await task
+                return (x, listener)
+            (x, listener) = asyncio.run(main())
+            abandoned = [event[2].func for event in listener.events
+                if event[0] == "abandoned"]
+            self.assertEqual(len(abandoned), 6)
+            self.assertEqual(abandoned[2:], funcs[::-1])
+            self.assertEqual(len(x), 0)
+
+    def test_context_manager(self):
+        (coroutine_func, func) = self.coroutine_func("North Bay")
+        async def main():
+            async with Cleanups() as x:
+                x.add(coroutine_func)
+                func.assertNotInvoked()
+        asyncio.run(main())
+        func.assertInvocation()
+
+    def test_max_concurrency(self):
+        state = {"running": 0, "max_running": 0}
+        async def coroutine_func():
+            state["running"] += 1
+            state["max_running"] = max(state["max_running"], state["running"])
+            await asyncio.sleep(0.01)
+            state["running"] -= 1
+        x = Cleanups()
+        for i in range(6):
+            x.add(coroutine_func)
+        listener = CleanupListenerHelper(self)
+        x.add_listener(listener)
+        asyncio.run(x.arun(max_concurrency=2))
+        listener.completed.assertInvocationCount(6)
+        self.assertEqual(state["max_running"], 2)
+
+    def test_dependencies(self):
+        (coroutine_func1, func1) = self.coroutine_func("Sault Ste. Marie")
+        (coroutine_func2, func2) = self.coroutine_func("Elliot Lake")
+        (coroutine_func3, func3) = self.coroutine_func("Blind River")
+        x = Cleanups()
+        c1 = x.add(coroutine_func1)
+        c2 = x.add(coroutine_func2)
+        x.add(coroutine_func3)
+        x.add_dependency(c2, c1)
+        asyncio.run(x.arun(max_concurrency=3))
+        func1.assertInvokedBefore(func2)
+
+    def test_starting_skips(self):
+        (coroutine_func, func) = self.coroutine_func("Kapuskasing")
+        x = Cleanups()
+        x.add(coroutine_func)
+        listener = CleanupListenerHelper(self)
+        listener.starting.retval = True
+        x.add_listener(listener)
+        asyncio.run(x.arun(max_concurrency=2))
+        func.assertNotInvoked()
+        listener.completed.assertNotInvoked()
+
+################################################################################
+
+class TestFileDeletions(CleanupsTestCase):
+    """
+    Tests Cleanups.add_unlink() and Cleanups.add_rmtree().
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir, ignore_errors=True)
+
+    def path(self, *names):
+        return os.path.join(self.dir, *names)
+
+    def create_file(self, *names):
+        path = self.path(*names)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb"):
+            pass
+        return path
+
+    def test_unlink(self):
+        paths = [self.create_file("d%i" % (i % 3), "f%i" % i)
+            for i in range(10)]
+        x = Cleanups()
+        for path in paths:
+            x.add_unlink(path)
+        self.assertEqual(len(x), 1)
+        listener = CleanupListenerHelper(self)
+        x.add_listener(listener)
+        x.run()
+        for path in paths:
+            self.assertFalse(os.path.exists(path))
+        listener.completed.assertInvocationCount(1)
+        listener.failed.assertNotInvoked()
+
+    def test_unlink_many(self):
+        paths = [self.create_file("d%i" % (i % 3), "f%i" % i)
+            for i in range(10)]
+        x = Cleanups()
+        x.add_unlink(paths[0])
+        x.add_unlink_many(iter(paths[1:]))
+        x.add_unlink_many([])
+        self.assertEqual(len(x), 1)
+        x.run()
+        for path in paths:
+            self.assertFalse(os.path.exists(path))
+
+    def test_unlink_many_empty(self):
+        x = Cleanups()
+        x.add_unlink_many([])
+        self.assertEqual(len(x), 0)
+
+    def test_rmtree(self):
+        self.create_file("a", "b", "c")
+        path1 = self.create_file("a", "f")
+        x = Cleanups()
+        x.add_rmtree(self.path("a"))
+        x.add_unlink(path1)
+        x.add_rmtree(self.path("a", "b"))
+        listener = CleanupListenerHelper(self)
+        x.add_listener(listener)
+        x.run()
+        self.assertFalse(os.path.exists(self.path("a")))
+        listener.failed.assertNotInvoked()
+
+    def test_order(self):
+        path1 = self.create_file("f1")
+        path2 = self.create_file("f2")
+        exists = []
+        def func():
+            exists.append((os.path.exists(path1), os.path.exists(path2)))
+        x = Cleanups()
+        x.add_unlink(path1)
+        x.add(func)
+        x.add_unlink(path2)
+        self.assertEqual(len(x), 3)
+        x.run()
+        self.assertEqual(exists, [(True, False)])
+        self.assertFalse(os.path.exists(path1))
+
+    def test_interleaved(self):
+        # a file registered before a directory tree is deleted after it
+        lock = self.create_file("lock")
+        work = os.path.dirname(self.create_file("work", "f"))
+        exists = []
+        class Listener(CleanupListener):
+            def completed(self, cleanups, cleanup, retval):
+                exists.append((os.path.exists(lock), os.path.exists(work)))
+        x = Cleanups()
+        x.add_unlink(lock)
+        x.add_rmtree(work)
+        self.assertEqual(len(x), 2)
+        x.add_listener(Listener())
+        x.run()
+        self.assertEqual(exists, [(True, False), (False, False)])
+
+    def test_failed(self):
+        path1 = self.create_file("f1")
+        path2 = self.path("f2")
+        path3 = self.create_file("f3")
+        x = Cleanups()
+        x.add_unlink(path1)
+        x.add_unlink(path2)
+        x.add_unlink(path3)
+        x.add_rmtree(self.path("d"))
+        listener = CleanupListenerHelper(self)
+        x.add_listener(listener)
+        x.run()
+        self.assertFalse(os.path.exists(path1))
+        self.assertFalse(os.path.exists(path3))
+        # the directory tree is deleted by a separate cleanup, first
+        listener.failed.assertInvocationCount(2)
+        errors = []
+        for invocation in listener.failed.invocations:
+            exception = invocation.args[3][1]
+            self.assertIsInstance(exception, cleanups.FileDeletionError)
+            errors.extend(exception.errors)
+        self.assertEqual([path for (path, e) in errors],
+            [self.path("d"), path2])
+        for (path, e) in errors:
+            self.assertIsInstance(e, FileNotFoundError)
+
+    def test_threads(self):
+        cleanups._FileDeletions.CHUNK_SIZE = 3
+        self.addCleanup(setattr, cleanups._FileDeletions, "CHUNK_SIZE", 1000)
+        paths = [self.create_file("d%i" % (i % 4), "f%i" % i)
+            for i in range(40)]
+        x = Cleanups(max_workers=4)
+        for path in paths:
+            x.add_unlink(path)
+        listener = CleanupListenerHelper(self)
+        x.add_listener(listener)
+        x.run()
+        for path in paths:
+            self.assertFalse(os.path.exists(path))
+        listener.failed.assertNotInvoked()
+
+################################################################################
+
+class TestJournal(CleanupsTestCase):
+    """
+    Tests journaling file deletions via the journal argument of Cleanups and
+    reaping them via cleanups.reap().
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir, ignore_errors=True)
+        self.journal = os.path.join(self.dir, "journal")
+
+    def create_file(self, name):
+        path = os.path.join(self.dir, name)
+        with open(path, "wb"):
+            pass
+        return path
+
+    def new_cleanups(self):
+        x = Cleanups(journal=self.journal)
+        self.addCleanup(x.journal.close)
+        return x
+
+    def read_journal(self):
+        with open(self.journal, "rb") as f:
+            records = cleanups._Journal.read(f.read())
+        return [path for (kind, path) in records.values()]
+
+    def test_records(self):
+        path1 = self.create_file("f1")
+        os.mkdir(os.path.join(self.dir, "d1"))
+        x = self.new_cleanups()
+        x.add_unlink(path1)
+        x.add_rmtree(os.path.join(self.dir, "d1"))
+        self.assertEqual(self.read_journal(),
+            [path1, os.path.join(self.dir, "d1")])
+
+    def test_absolute_paths(self):
+        x = self.new_cleanups()
+        x.add_unlink("Elliot Lake")
+        self.assertEqual(self.read_journal(),
+            [os.path.abspath("Elliot Lake")])
+
+    def test_run_forgets(self):
+        paths = [self.create_file("f%i" % i) for i in range(3)]
+        x = self.new_cleanups()
+        x.add_unlink(paths[0])
+        x.add(self.func("Blind River"))
+        x.add_unlink(paths[1])
+        x.add_unlink(paths[2])
+        x.run()
+        self.assertEqual(self.read_journal(), [])
+        for path in paths:
+            self.assertFalse(os.path.exists(path))
+
+    def test_failed_deletion_forgets(self):
+        x = self.new_cleanups()
+        x.add_unlink(os.path.join(self.dir, "missing"))
+        x.run()
+        self.assertEqual(self.read_journal(), [])
+
+    def test_partial_run_forgets(self):
+        path1 = self.create_file("f1")
+        path2 = self.create_file("f2")
+        x = self.new_cleanups()
+        x.add_unlink(path1)
+        x.add(self.func("Thessalon"))
+        x.add_unlink(path2)
+        x.remove(next(cleanup for cleanup in x.back.values()
+            if cleanup.name == "delete files"))
+        self.assertEqual(self.read_journal(), [path2])
+        x.run()
+        self.assertEqual(self.read_journal(), [])
+
+    def test_skipped_forgets(self):
+        path1 = self.create_file("f1")
+        class SkippingListener(CleanupListener):
+            def starting(self, cleanups, cleanup):
+                return True
+        x = self.new_cleanups()
+        x.add_unlink(path1)
+        x.add_listener(SkippingListener())
+        x.run()
+        self.assertTrue(os.path.exists(path1))
+        self.assertEqual(self.read_journal(), [])
+        self.assertEqual(x.journal.live, 0)
+
+    def test_abandoned_forgets(self):
+        path1 = self.create_file("f1")
+        x = self.new_cleanups()
+        x.add_unlink(path1)
+        x.run(deadline=0)
+        self.assertTrue(os.path.exists(path1))
+        self.assertEqual(self.read_journal(), [])
+
+    def test_arun_skipped_forgets(self):
+        path1 = self.create_file("f1")
+        class SkippingListener(CleanupListener):
+            def starting(self, cleanups, cleanup):
+                return True
+        x = self.new_cleanups()
+        x.add_unlink(path1)
+        x.add_listener(SkippingListener())
+        asyncio.run(x.arun())
+        self.assertTrue(os.path.exists(path1))
+        self.assertEqual(self.read_journal(), [])
+
+    def test_clear_forgets(self):
+        x = self.new_cleanups()
+        x.add_unlink(self.create_file("f1"))
+        x.clear()
+        self.assertEqual(self.read_journal(), [])
+
+    def test_child_shares_journal(self):
+        path1 = self.create_file("f1")
+        x = self.new_cleanups()
+        x.child().add_unlink(path1)
+        self.assertEqual(self.read_journal(), [path1])
+
+    def test_grow(self):
+        x = self.new_cleanups()
+        names = ["%s_%i" % ("Wawa" * 20, i) for i in range(2000)]
+        for name in names:
+            x.add_unlink(os.path.join(self.dir, name))
+        self.assertGreater(os.path.getsize(self.journal),
+            cleanups._Journal.INITIAL_SIZE)
+        self.assertEqual(self.read_journal(),
+            [os.path.join(self.dir, name) for name in names])
+
+    def test_reap(self):
+        path1 = self.create_file("f1")
+        path2 = os.path.join(self.dir, "d1")
+        os.makedirs(os.path.join(path2, "d2"))
+        x = self.new_cleanups()
+        x.add_unlink(path1)
+        x.add_rmtree(path2)
+        x.add_unlink(os.path.join(self.dir, "missing"))
+        # simulate the process being killed
+        x.journal.close()
+        self.assertEqual(cleanups.reap(self.journal), 3)
+        self.assertFalse(os.path.exists(path1))
+        self.assertFalse(os.path.exists(path2))
+        self.assertFalse(os.path.exists(self.journal))
+
+    def test_reap_not_journal(self):
+        path1 = self.create_file("f1")
+        with self.assertRaises(ValueError):
+            cleanups.reap(path1)
+        self.assertTrue(os.path.exists(path1))
+
+    def test_pending_journal(self):
+        x = self.new_cleanups()
+        x.add_unlink(self.create_file("f1"))
+        x.journal.close()
+        with self.assertRaises(ValueError):
+            Cleanups(journal=self.journal)
+
+    def test_reuse_journal(self):
+        path1 = self.create_file("f1")
+        x = self.new_cleanups()
+        x.add_unlink(self.create_file("f2"))
+        x.run()
+        x.journal.close()
+        y = self.new_cleanups()
+        y.add_unlink(path1)
+        self.assertEqual(self.read_journal(), [path1])
+
+    def test_main(self):
+        path1 = self.create_file("f1")
+        x = self.new_cleanups()
+        x.add_unlink(path1)
+        x.journal.close()
+        stdout = io.StringIO()
+        stderr = io.StringIO()
+        with contextlib.redirect_stdout(stdout), \
+                contextlib.redirect_stderr(stderr):
+            status = cleanups.main(["reap", self.journal,
+                os.path.join(self.dir, "missing")])
+        self.assertEqual(status, 1)
+        self.assertFalse(os.path.exists(path1))
+        self.assertIn("reaped 1 path(s)", stdout.getvalue())
+        self.assertIn("missing", stderr.getvalue())
+
+################################################################################
+
+class TestListenerDispatch(CleanupsTestCase):
+    """
+    Tests the dispatching of events to listeners by Cleanups.run().
+    """
+
+    def test_subclass(self):
+        func = self.func("Windsor", retval=5)
+        x = Cleanups()
+        cleanup = x.add(func)
+        listener = RecordingCleanupListener()
+        x.add_listener(listener)
+        x.run()
+        self.assertEqual(listener.events, [
+            ("starting", x, cleanup),
+            ("completed", x, cleanup, 5),
+        ])
+
+    def test_subclass_partial_override(self):
+        class Listener(CleanupListener):
+            def __init__(self):
+                self.retvals = []
+            def completed(self, cleanups, cleanup, retval):
+                self.retvals.append(retval)
+        x = Cleanups()
+        x.add(self.func("Leamington", retval=1))
+        x.add(self.func("Kingsville", exception=KeyError()))
+        listener = Listener()
+        x.add_listener(listener)
+        x.run()
+        self.assertEqual(listener.retvals, [1])
+
+    def test_debug_listener(self):
+        out = io.StringIO()
+        x = Cleanups()
+        x.add(self.func("Amherstburg", retval="abc"))
+        x.add_listener(DebugCleanupListener(f=out))
+        x.run()
+        self.assertEqual(out.getvalue(),
+            "Starting cleanup operation: 1\n" +
+            "Cleanup operation completed successfully: 1 (returned 'abc')\n")
+
+    def test_listener_exception(self):
+        class Listener(CleanupListener):
+            def starting(self, cleanups, cleanup):
+                raise KeyError("Tecumseh")
+        func = self.func("Essex")
+        x = Cleanups()
+        x.add(func)
+        x.add_listener(Listener())
+        listener = RecordingCleanupListener()
+        x.add_listener(listener)
+        stderr = io.StringIO()
+        orig_stderr = sys.stderr
+        sys.stderr = stderr
+        try:
+            x.run()
+        finally:
+            sys.stderr = orig_stderr
+        func.assertInvocation()
+        self.assertEqual(len(listener.events), 2)
+        self.assertIn("KeyError: 'Tecumseh'", stderr.getvalue())
+
+    def test_method_assigned_after_run(self):
+        x = Cleanups()
+        listener = CleanupListener()
+        x.add_listener(listener)
+        x.add(self.func("Lakeshore"))
+        x.run()
+        completed = []
+        listener.completed = lambda self, cleanups, cleanup, retval: \
+            completed.append(retval)
+        x.add(self.func("LaSalle", retval=7))
+        x.run()
+        self.assertEqual(completed, [7])
+
+    def test_method_patched_after_run(self):
+        class Listener(CleanupListener):
+            pass
+        x = Cleanups()
+        x.add_listener(Listener())
+        x.add(self.func("Belle River"))
+        x.run()
+        failed = []
+        Listener.failed = lambda self, cleanups, cleanup, exc_info: \
+            failed.append(exc_info[1])
+        exception = KeyError("Tilbury")
+        x.add(self.func("Tilbury", exception=exception))
+        x.run()
+        self.assertEqual(failed, [exception])
+
+    def test_no_listeners(self):
+        func = self.func("Chatham", exception=KeyError("Chatham"))
+        x = Cleanups()
+        x.add(func)
+        x.run()
+        func.assertInvocation()
+        notifier = cleanups._CleanupListenerNotifier(x, (), ())
+        self.assertEqual(notifier.starting_funcs, ())
+        self.assertEqual(notifier.completed_funcs, ())
+        self.assertEqual(notifier.failed_funcs, ())
+
 ################################################################################
 
 class TestCleanupListener(CleanupsTestCase):
     """
-    Tests the CleanupListener class.  Since this class is just 3 empty methods,
+    Tests the CleanupListener class.  Since this class is just 5 empty methods,
     try and invoke those methods and ensure that they return None.
     """
 
@@ -190,6 +2189,8 @@ class TestCleanupListener(CleanupsTestCase):
         self.assertIsNone(x.starting(None, None))
         self.assertIsNone(x.completed(None, None, None))
         self.assertIsNone(x.failed(None, None, None))
+        self.assertIsNone(x.abandoned(None, None))
+        self.assertIsNone(x.finished(None))
 
 ################################################################################
 
@@ -240,6 +2241,15 @@ class TestDebugCleanupListener(CleanupsTestCase):
         x.log.assertInvocation("Cleanup operation FAILED: 345 (7)")
         traceback.print_exception.assertInvocation(*exc_info)
 
+    def test_abandoned(self):
+        x = DebugCleanupListener(f=self.tempfile())
+        self.assertIsNone(x.abandoned(None, None))
+        x.log = FunctionSimulator(self, name="log")
+        cleanups = Cleanups()
+        cleanup = Cleanup(cleanups, 456, None, [], {})
+        x.abandoned(cleanups, cleanup)
+        x.log.assertInvocation("Cleanup operation ABANDONED: 456")
+
     def test_log(self):
         out = io.StringIO()
         message = "This is a test message"
@@ -262,6 +2272,195 @@ class TestDebugCleanupListener(CleanupsTestCase):
 
 ################################################################################
 
+class TestLoggingCleanupListener(CleanupsTestCase):
+    """
+    Tests the LoggingCleanupListener class.
+    """
+
+    def setUp(self):
+        self.logger = logging.getLogger("test_cleanups.%s" % self.id())
+        self.logger.propagate = False
+        self.logger.setLevel(logging.DEBUG)
+        self.records = []
+        handler = logging.Handler()
+        handler.emit = self.records.append
+        self.logger.addHandler(handler)
+        self.addCleanup(self.logger.removeHandler, handler)
+
+    def messages(self):
+        return [(record.levelno, record.getMessage())
+            for record in self.records]
+
+    def test__init__(self):
+        x = LoggingCleanupListener()
+        self.assertIs(x.logger, logging.getLogger("cleanups"))
+        self.assertEqual(x.level, logging.DEBUG)
+        self.assertEqual(x.failed_level, logging.ERROR)
+        self.assertEqual(x.abandoned_level, logging.WARNING)
+        self.assertIsInstance(x, CleanupListener)
+
+    def test_run(self):
+        x = Cleanups()
+        x.add_listener(LoggingCleanupListener(self.logger))
+        c1 = x.add(self.func("Guelph", retval=5))
+        c2 = x.add(self.func("Fergus", exception=KeyError("Fergus")))
+        x.run()
+        self.assertEqual(self.messages(), [
+            (logging.DEBUG, "Starting cleanup operation: %s" % c2),
+            (logging.ERROR, "Cleanup operation FAILED: %s ('Fergus')" % c2),
+            (logging.DEBUG, "Starting cleanup operation: %s" % c1),
+            (logging.DEBUG, "Cleanup operation completed successfully: %s "
+                "(returned 5)" % c1),
+        ])
+        self.assertIs(self.records[1].exc_info[0], KeyError)
+        self.assertIn("KeyError",
+            logging.Formatter().format(self.records[1]))
+
+    def test_abandoned(self):
+        x = Cleanups()
+        x.add_listener(LoggingCleanupListener(self.logger))
+        c1 = x.add(self.func("Elora"))
+        x.run(deadline=0)
+        self.assertEqual(self.messages(), [
+            (logging.WARNING, "Cleanup operation ABANDONED: %s" % c1),
+        ])
+
+    def test_level_disabled(self):
+        self.logger.setLevel(logging.INFO)
+        listener = LoggingCleanupListener(self.logger)
+        x = Cleanups()
+        x.add_listener(listener)
+        x.add(self.func("Rockwood"))
+        x.run()
+        self.assertEqual(self.records, [])
+        self.assertIsNone(listener.thread)
+
+    def test_levels(self):
+        listener = LoggingCleanupListener(self.logger, level=logging.INFO,
+            failed_level=logging.CRITICAL)
+        x = Cleanups()
+        x.add_listener(listener)
+        x.add(self.func("Erin", exception=KeyError("Erin")))
+        x.run()
+        self.assertEqual([levelno for (levelno, message) in self.messages()],
+            [logging.INFO, logging.CRITICAL])
+
+    def test_flush(self):
+        listener = LoggingCleanupListener(self.logger)
+        self.assertTrue(listener.flush())
+        cleanup = Cleanup(None, 1, None, (), {})
+        listener.starting(None, cleanup)
+        self.assertTrue(listener.flush(timeout=10))
+        self.assertEqual(self.messages(),
+            [(logging.DEBUG, "Starting cleanup operation: 1")])
+
+################################################################################
+
+def tillsonburg():
+    pass
+
+class TestTimingCleanupListener(CleanupsTestCase):
+    """
+    Tests the TimingCleanupListener class.
+    """
+
+    def test_inheritence(self):
+        x = TimingCleanupListener()
+        self.assertIsInstance(x, CleanupListener)
+
+    def test_skipped(self):
+        class SkippingListener(CleanupListener):
+            def starting(self, cleanups, cleanup):
+                return True
+        listener = TimingCleanupListener()
+        x = Cleanups()
+        x.add_listener(listener)
+        x.add_listener(SkippingListener())
+        for i in range(10):
+            x.add(self.func("Delhi"))
+        x.run()
+        self.assertEqual(listener.starts, {})
+        self.assertEqual(listener.summary()["cleanups"], {})
+
+    def test_key(self):
+        x = TimingCleanupListener()
+        cleanup = Cleanup(None, 1, tillsonburg, (), {})
+        self.assertEqual(x.key(cleanup), __name__ + ".tillsonburg")
+        cleanup.name = "Ingersoll"
+        self.assertEqual(x.key(cleanup), "Ingersoll")
+        cleanup = Cleanup(None, 2, self.func("Woodstock"), (), {})
+        self.assertEqual(x.key(cleanup), __name__ + ".FunctionSimulator")
+
+    def test_run(self):
+        listener = TimingCleanupListener()
+        x = Cleanups()
+        x.add_listener(listener)
+        x.add(time.sleep, 0.02).name = "sleep"
+        x.add(time.sleep, 0).name = "sleep"
+        x.add(tillsonburg)
+        x.add(self.func("Simcoe", exception=KeyError("Simcoe"))).name = "fail"
+        x.run()
+        summary = listener.summary()
+        stats = summary["cleanups"]["sleep"]
+        self.assertEqual(stats["count"], 2)
+        self.assertEqual(stats["failures"], 0)
+        self.assertGreaterEqual(stats["max_ns"], 20000000)
+        self.assertLessEqual(stats["min_ns"], stats["max_ns"])
+        self.assertEqual(stats["mean_ns"], stats["total_ns"] // 2)
+        self.assertEqual(sum(count for (bound, count) in stats["histogram"]),
+            2)
+        for (bound, count) in stats["histogram"]:
+            self.assertEqual(bound & (bound - 1), 0)
+        self.assertEqual(summary["cleanups"]["fail"]["failures"], 1)
+        self.assertEqual(
+            summary["cleanups"][__name__ + ".tillsonburg"]["count"], 1)
+        self.assertEqual(summary["slowest"][0][0], "sleep")
+        self.assertEqual(len(summary["slowest"]), 4)
+        self.assertEqual(json.loads(listener.to_json()), summary)
+
+    def test_slowest(self):
+        listener = TimingCleanupListener(slowest=2)
+        x = Cleanups()
+        x.add_listener(listener)
+        for (i, seconds) in enumerate([0, 0.1, 0, 0.03, 0]):
+            x.add(time.sleep, seconds).name = "sleep_%i" % i
+        x.run()
+        self.assertEqual([key for (key, ns) in listener.summary()["slowest"]],
+            ["sleep_1", "sleep_3"])
+
+    def test_abandoned(self):
+        listener = TimingCleanupListener()
+        x = Cleanups()
+        x.add_listener(listener)
+        x.add(self.func("Delhi")).name = "Delhi"
+        x.run(deadline=0)
+        stats = listener.summary()["cleanups"]["Delhi"]
+        self.assertEqual(stats["abandoned"], 1)
+        self.assertEqual(stats["count"], 0)
+        self.assertIsNone(stats["mean_ns"])
+
+    def test_concurrent(self):
+        listener = TimingCleanupListener()
+        x = Cleanups()
+        x.add_listener(listener)
+        for i in range(100):
+            x.add(tillsonburg)
+        x.run(max_workers=4)
+        stats = listener.summary()["cleanups"][__name__ + ".tillsonburg"]
+        self.assertEqual(stats["count"], 100)
+        self.assertEqual(listener.starts, {})
+
+    def test_reset(self):
+        listener = TimingCleanupListener()
+        x = Cleanups()
+        x.add_listener(listener)
+        x.add(tillsonburg)
+        x.run()
+        listener.reset()
+        self.assertEqual(listener.summary(), {"cleanups": {}, "slowest": []})
+
+################################################################################
+
 class TestCleanup(CleanupsTestCase):
     """Tests the Cleanup class"""
 
@@ -288,6 +2487,44 @@ class TestCleanup(CleanupsTestCase):
         with self.assertRaises(TypeError):
             Cleanup(cleanups, id, func, [], 5)
 
+    def test__init__defaults(self):
+        x = Cleanup(None, 1, None, (), {})
+        self.assertIsNone(x.name)
+        self.assertEqual(x.priority, 0)
+        self.assertFalse(x.run_in_process)
+        self.assertIsNone(x.timeout)
+        self.assertFalse(x.best_effort)
+        self.assertFalse(x.inheritable)
+
+    def test__init__no_copy(self):
+        args = (1, 2)
+        x1 = Cleanup(None, 1, None, args, {})
+        x2 = Cleanup(None, 2, None, [], [])
+        self.assertIs(x1.args, args)
+        self.assertEqual(x2.args, ())
+        self.assertIs(x1.kwargs, x2.kwargs)
+        self.assertEqual(x1.kwargs, {})
+
+    def test_slots(self):
+        x = Cleanup(None, 1, None, (), {})
+        with self.assertRaises(AttributeError):
+            x.__dict__
+        with self.assertRaises(AttributeError):
+            x.undefined_attribute = 5
+
+    def test_options_shared(self):
+        x1 = Cleanup(None, 1, None, (), {})
+        x2 = Cleanup(None, 2, None, (), {})
+        self.assertIs(x1._options, x2._options)
+        x1.timeout = 5
+        x1.tags += ("Kemptville",)
+        self.assertIsNot(x1._options, x2._options)
+        self.assertEqual(x1.timeout, 5)
+        self.assertEqual(x1.tags, ("Kemptville",))
+        self.assertEqual(x1.priority, 0)
+        self.assertIsNone(x2.timeout)
+        self.assertEqual(x2.tags, ())
+
     def test__str__(self):
         x = Cleanup(None, 20, None, (), {})
         self.assertEqual(str(x), "20")
@@ -601,5 +2838,28 @@ class CleanupListenerHelper():
 
 ################################################################################
 
+class RecordingCleanupListener(CleanupListener):
+    """
+    A subclass of `CleanupListener` that records the events of which it is
+    notified in a list of tuples.
+    """
+
+    def __init__(self):
+        self.events = []
+
+    def starting(self, cleanups, cleanup):
+        self.events.append(("starting", cleanups, cleanup))
+
+    def completed(self, cleanups, cleanup, retval):
+        self.events.append(("completed", cleanups, cleanup, retval))
+
+    def failed(self, cleanups, cleanup, exc_info):
+        self.events.append(("failed", cleanups, cleanup, exc_info))
+
+    def abandoned(self, cleanups, cleanup):
+        self.events.append(("abandoned", cleanups, cleanup))
+
+################################################################################
+
 if __name__ == "__main__":
     unittest.main()